@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Compares the cost of building a command message per publish with reusing
+Drive's preallocated one.
+
+"fresh" is what Drive used to do on every publish: a new Twist with all six
+fields set one by one. "reused" is Drive.set_velocity, which sets vx and wz
+on the one Twist Drive keeps. Both publish to a stand-in for rospy's
+Publisher that serializes the message the way publish() does (when the
+message class can serialize, as genpy's do), so run it on the robot:
+
+    $ python3 bench/bench_twist.py
+    $ python3 bench/bench_twist.py --publishes 200000
+
+It reports wall time per publish, CPU time per publish, and bytes allocated
+per publish (traced with tracemalloc in a separate, shorter pass, since
+tracing slows everything down).
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+from io import BytesIO
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from geometry_msgs.msg import Twist
+
+from Drive import Drive
+
+class SerializingPublisher():
+    """Does the work rospy's Publisher.publish does in the caller's thread"""
+
+    def __init__(self):
+        self.buffer = BytesIO()
+
+    def publish(self, message):
+        if hasattr(message, 'serialize'):
+            self.buffer.seek(0)
+            message.serialize(self.buffer)
+
+def fresh_publisher(publisher):
+    def publish(vx, wz):
+        vel_msg = Twist()
+        vel_msg.linear.x = vx
+        vel_msg.linear.y = 0
+        vel_msg.linear.z = 0
+        vel_msg.angular.x = 0
+        vel_msg.angular.y = 0
+        vel_msg.angular.z = wz
+        publisher.publish(vel_msg)
+    return publish
+
+def reused_publisher(publisher):
+    # Just the state set_velocity uses, without Drive's ROS setup
+    vel_msg = Twist()
+    drive = SimpleNamespace(vel_msg=vel_msg, _linear=vel_msg.linear, _angular=vel_msg.angular)
+
+    def publish(vx, wz):
+        publisher.publish(Drive.set_velocity(drive, vx, wz))
+    return publish
+
+def time_publishes(publish, count):
+    """(wall sec, CPU sec) per publish"""
+    wall_started = time.perf_counter()
+    cpu_started = time.process_time()
+
+    for i in range(count):
+        publish(0.5, 0.0)
+
+    return (time.perf_counter() - wall_started) / count, (time.process_time() - cpu_started) / count
+
+def allocated_per_publish(publish, count):
+    """Mean bytes allocated (and freed again) by a publish"""
+    samples = []
+    tracemalloc.start()
+    for i in range(count):
+        # Zeroes the traced and peak counters; reset_peak() would need 3.9 and the Pi has 3.7
+        tracemalloc.clear_traces()
+        publish(0.5, 0.0)
+        current, peak = tracemalloc.get_traced_memory()
+        samples.append(peak)
+    tracemalloc.stop()
+
+    return statistics.mean(samples)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--publishes', type=int, default=100000, help="publishes timed per variant")
+    parser.add_argument('--traced', type=int, default=2000, help="publishes traced for allocations per variant")
+    parser.add_argument('--rounds', type=int, default=5, help="timing rounds per variant; the best is reported")
+    args = parser.parse_args()
+
+    publisher = SerializingPublisher()
+    print(f"serializing: {hasattr(Twist(), 'serialize')}")
+
+    for name, make in (("fresh", fresh_publisher), ("reused", reused_publisher)):
+        publish = make(publisher)
+        publish(0.0, 0.0)  # warm up
+
+        wall, cpu = min(time_publishes(publish, args.publishes) for i in range(args.rounds))
+        allocated = allocated_per_publish(publish, args.traced)
+        print(f"{name:<8} {wall * 1e6:8.3f} us/publish  {cpu * 1e6:8.3f} us CPU/publish  {allocated:8.1f} bytes allocated/publish")
+
+if __name__ == '__main__':
+    main()
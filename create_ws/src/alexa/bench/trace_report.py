@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Renders voice-to-motion latency by stage from captured traces.
+
+The listener appends one JSON line per directive to ~trace_log (see
+src/tracing.py for the stages). Copy it off the robot, or pipe it in:
+
+    $ python3 bench/trace_report.py traces.jsonl
+    $ ssh pi@robot cat /tmp/traces.jsonl | python3 bench/trace_report.py --last 20
+
+It prints count, mean and percentiles per stage with each stage's share of the
+total, then a bar per trace for the last --last traces:
+
+    s = skill, t = transit, q = queue, m = start (first /cmd_vel publish)
+
+Histogram snapshots captured from the metrics topic (lines with "stages") are
+summarized as they were published, with the robot's directive counts
+(accepted, expired, duplicates) and transit latency.
+"""
+import argparse
+import fileinput
+import json
+import statistics
+
+STAGES = ("skill", "transit", "queue", "start")
+BAR_CHARS = {"skill": "s", "transit": "t", "queue": "q", "start": "m"}
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+def load(paths):
+    traces, snapshots = [], []
+    for line in fileinput.input(paths):
+        line = line.strip()
+        if not line:
+            continue
+
+        record = json.loads(line)
+        if 'stages' in record:
+            snapshots.append(record)
+        elif 'total_ms' in record:
+            traces.append(record)
+
+    return traces, snapshots
+
+def report_stages(traces):
+    total = sum(trace['total_ms'] for trace in traces)
+    print(f"{'stage':<8} {'n':>6} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9} {'share':>7}")
+
+    for stage in STAGES + ("total",):
+        values = [trace[stage + '_ms'] for trace in traces]
+        share = sum(values) / total * 100 if total else 0.0
+        print(f"{stage:<8} {len(values):>6} {statistics.mean(values):>9.2f} {percentile(values, 50):>9.2f} "
+              f"{percentile(values, 95):>9.2f} {percentile(values, 99):>9.2f} {max(values):>9.2f} {share:>6.1f}%")
+
+def report_traces(traces, width):
+    longest = max(trace['total_ms'] for trace in traces) or 1.0
+    for trace in traces:
+        bar = "".join(BAR_CHARS[stage] * round(trace[stage + '_ms'] / longest * width) for stage in STAGES)
+        print(f"{str(trace.get('cid'))[:8]:<8} {str(trace.get('directive')):<8} {trace['total_ms']:>9.1f} ms |{bar}")
+
+def report_snapshot(snapshot):
+    print(f"{snapshot['traced']} traced")
+    for stage, histogram in snapshot['stages'].items():
+        print(f"  {stage:<8} n={histogram['count']:<6} mean={histogram['mean_ms']} ms  "
+              f"p50<={histogram['p50_ms']} p95<={histogram['p95_ms']} p99<={histogram['p99_ms']} max={histogram['max_ms']} ms")
+
+    directives = snapshot.get('directives')
+    if directives:
+        print(f"Directives: {directives['accepted']} accepted, {directives['expired']} expired, "
+              f"{directives['duplicates']} duplicates (rate {directives['duplicate_rate']}), "
+              f"transit mean={directives['mean_latency_ms']} ms max={directives['max_latency_ms']} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='*', help="trace logs (default: stdin)")
+    parser.add_argument('--last', type=int, default=10, help="traces to draw, 0 for none")
+    parser.add_argument('--width', type=int, default=60, help="characters for the longest trace's bar")
+    args = parser.parse_args()
+
+    traces, snapshots = load(args.paths)
+
+    if traces:
+        report_stages(traces)
+        if args.last:
+            print()
+            report_traces(traces[-args.last:], args.width)
+
+    if snapshots:
+        if traces:
+            print()
+        print("Latest published histograms:")
+        report_snapshot(snapshots[-1])
+
+    if not traces and not snapshots:
+        print("No traces found")
+
+if __name__ == '__main__':
+    main()
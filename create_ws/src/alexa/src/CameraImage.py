@@ -1,8 +1,10 @@
 import boto3
 import io
+import os
 import rospy
 import sys
 
+from botocore.exceptions import ClientError
 from io import BytesIO
 from picamera import PiCamera
 from PIL import Image, ImageDraw, ExifTags, ImageColor, ImageFont
@@ -19,8 +21,8 @@ dynamodb_client = boto3.client('dynamodb')
 camera = PiCamera()
 camera.rotation = 180
 
-# Load font for labels
-font = ImageFont.truetype("./Amazon-Ember-Regular.ttf",12)
+# Load font for labels, which ships next to this file: roslaunch runs nodes from ~/.ros
+font = ImageFont.truetype(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Amazon-Ember-Regular.ttf"),12)
 
 class CameraImage():
     """Functions to interact with images from Raspberry Pi camera
@@ -146,7 +148,18 @@ class CameraImage():
 
         return self.labels
 
-    def save_scene(self, session_id):
+    def scene(self, session_id, correlation_id=None):
+        """Compact scene result (people/objects in scene) for a session, tagged
+        with the id of the request that asked for it
+        """
+        return {
+            'session_id': session_id,
+            'correlation_id': correlation_id,
+            'recognized_people': self.recognized_people,
+            'labels': self.labels
+        }
+
+    def save_scene(self, session_id, correlation_id=None):
         """Saves annotations and writes results (objects/people in scene) to DDB
         """
 
@@ -155,11 +168,7 @@ class CameraImage():
         self.upload_annotated_image_to_s3('annotated.jpg')
 
         table = dynamodb_resource.Table('TwitchRobot_Scenes')
-        payload = {
-            'session_id': session_id,
-            'recognized_people': self.recognized_people,
-            'labels': self.labels
-        }
+        payload = self.scene(session_id, correlation_id)
         
         try:
             response = table.put_item(
@@ -0,0 +1,218 @@
+import heapq
+import itertools
+import threading
+import time
+
+from concurrent.futures import Future
+
+import rospy
+
+from MotionScript import compile_script
+
+# Lower runs first; "stop" also preempts whatever is running
+PRIORITIES = {"stop": 0}
+DEFAULT_PRIORITY = 1
+
+class MotionRejected(Exception):
+    """The command was unknown, or the queue was full"""
+
+class CommandExecutor():
+    """Runs drive commands on a single motion worker thread, the only thread
+    that publishes to /cmd_vel, so the MQTT callback thread only has to queue
+    them and can always deliver a "stop".
+
+    To use:
+    >>> executor = CommandExecutor(drive)
+    >>> executor.start()
+    >>> turning = executor.submit("spin", angle=90)
+    >>> take_picture()  # while the robot turns
+    >>> turning.result()  # the spin's MotionResult
+
+    Every submit returns a concurrent.futures.Future for the primitive's
+    MotionResult, which the caller can wait on, add callbacks to, or pass to
+    cancel(). chain() runs several primitives back to back behind one future.
+
+    Pending commands wait in a bounded priority queue. A "stop" cancels
+    everything still pending and preempts the running primitive, which returns
+    at its next control tick.
+    """
+
+    def __init__(self, drive, max_pending=8):
+        self.drive = drive
+        self.max_pending = max_pending
+
+        self.commands = {
+            "forward": drive.forward,
+            "spin": drive.spin,
+            "stop": drive.stop,
+            "script": self._script
+        }
+
+        self.executed = 0
+        self.dropped = 0
+        self.preempted = 0
+        self.cancelled = 0
+
+        self._pending = []  # heap of (priority, sequence, command, params, trace, future)
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._running = False
+        self._current = None  # future of the running primitive
+        self._worker = threading.Thread(target=self._run, name="motion-worker", daemon=True)
+
+    def _script(self, steps):
+        drive = self.drive
+        return drive.run_schedule(compile_script(steps, drive.control_loop.hz, drive.linear_accel,
+                                                 drive.angular_accel, drive.profile_shape))
+
+    def start(self):
+        self._running = True
+        self._worker.start()
+
+    def shutdown(self):
+        with self._condition:
+            self._running = False
+            self._cancel_pending()
+            self._condition.notify()
+
+        self.drive.preempt()
+        self._worker.join(timeout=2)
+
+    def _cancel_pending(self):
+        """Cancels every queued command. Call with the condition held."""
+        for entry in self._pending:
+            entry[-1].cancel()
+        self.dropped += len(self._pending)
+        self._pending.clear()
+
+    def _rejected(self, reason):
+        future = Future()
+        future.set_exception(MotionRejected(reason))
+        return future
+
+    def submit(self, command, trace=None, **params):
+        """Queues a command without blocking. Returns a Future for its
+        MotionResult, which fails with MotionRejected if the command was
+        unknown or the queue was full. A tracing.Trace is stamped when the
+        command is dequeued and finished once it has run."""
+        if command not in self.commands:
+            rospy.logwarn(f"Ignoring unknown command {command}")
+            return self._rejected(f"unknown command {command}")
+
+        priority = PRIORITIES.get(command, DEFAULT_PRIORITY)
+        future = Future()
+
+        with self._condition:
+            if command == "stop":
+                # Nothing queued before a stop should still run after it
+                self._cancel_pending()
+                if self._current is not None:
+                    self.preempted += 1
+                    self.drive.preempt()
+            elif len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return self._rejected("queue full")
+
+            heapq.heappush(self._pending, (priority, next(self._sequence), command, params, trace, future))
+            self._condition.notify()
+
+        return future
+
+    def cancel(self, future):
+        """Cancels a queued command, or preempts it if it's already running.
+        A preempted primitive still stops the robot and resolves its future
+        with what it achieved."""
+        if future.cancel():
+            self.cancelled += 1
+            return True
+
+        with self._condition:
+            if future is self._current:
+                self.cancelled += 1
+                self.drive.preempt()
+                return True
+
+        return False
+
+    def chain(self, *steps):
+        """Runs (command, params) steps one after another, each queued once the
+        previous one is done. Returns a Future for the list of their
+        MotionResults; cancelling it cancels whichever step is queued or
+        running, and a cancelled, preempted or failed step ends the chain."""
+        chained = Future()
+        results = []
+        current = []  # future of the step in flight
+
+        def next_step(previous=None):
+            if previous is not None:
+                if previous.cancelled():
+                    chained.cancel()
+                    return
+                if previous.exception() is not None:
+                    if not chained.done():
+                        chained.set_exception(previous.exception())
+                    return
+
+                results.append(previous.result())
+                if results[-1].stats.preempted and not chained.done():
+                    chained.set_result(results)
+
+            if chained.done():
+                return
+            if len(results) == len(steps):
+                chained.set_result(results)
+                return
+
+            command, params = steps[len(results)]
+            current[:] = [self.submit(command, **params)]
+            current[0].add_done_callback(next_step)
+
+        def on_done(future):
+            if future.cancelled() and current:
+                self.cancel(current[0])
+
+        chained.add_done_callback(on_done)
+        next_step()
+        return chained
+
+    def snapshot(self):
+        return {
+            'executed': self.executed,
+            'dropped': self.dropped,
+            'preempted': self.preempted,
+            'cancelled': self.cancelled,
+            'pending': len(self._pending)
+        }
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._current = None
+                while self._running and not self._pending:
+                    self._condition.wait()
+
+                if not self._running:
+                    return
+
+                priority, sequence, command, params, trace, future = heapq.heappop(self._pending)
+                if not future.set_running_or_notify_cancel():
+                    continue  # cancelled while it was queued
+
+                if trace is not None:
+                    trace.dequeued = time.monotonic()
+                    self.drive.trace = trace
+
+                # Cleared under the lock, so a stop submitted from here on still preempts
+                self.drive.preempted.clear()
+                self._current = future
+
+            try:
+                future.set_result(self.commands[command](**params))
+                self.executed += 1
+            except Exception as e:
+                rospy.logerr(f"Command {command} failed: {e}")
+                future.set_exception(e)
+            finally:
+                self.drive.trace = None
+                if trace is not None:
+                    trace.finish()
@@ -0,0 +1,66 @@
+import time
+
+from collections import namedtuple
+
+LoopStats = namedtuple('LoopStats', ['name', 'ticks', 'seconds', 'cpu_seconds', 'mean_jitter_ms', 'max_jitter_ms', 'preempted'])
+
+class ControlLoop():
+    """Calls a primitive's tick at a fixed rate, sleeping between ticks
+    instead of spinning, and reports how late the ticks were and how much CPU
+    the primitive used.
+
+    To use:
+    >>> loop = ControlLoop(10, drive.preempted)
+    >>> loop.run("spin", lambda: publisher.publish(vel_msg), duration=6)
+
+    Sleeps wait on the preempted event, so a preempted primitive returns as
+    soon as the event is set rather than at the end of the tick.
+    """
+
+    def __init__(self, hz, preempted):
+        self.hz = hz
+        self.period = 1.0 / hz
+        self.preempted = preempted
+
+    def run(self, name, tick, duration=None):
+        """Calls tick() every period until it returns False, duration (sec)
+        has passed, or we're preempted. Returns a LoopStats.
+        """
+        started = time.monotonic()
+        cpu_started = time.thread_time()
+        next_tick = started
+        ticks = 0
+        jitter_total = jitter_max = 0.0
+        preempted = self.preempted.is_set()
+
+        while not preempted:
+            now = time.monotonic()
+            if duration is not None and now - started >= duration:
+                break
+
+            jitter = now - next_tick
+            jitter_total += jitter
+            jitter_max = max(jitter_max, jitter)
+
+            if tick() is False:
+                break
+            ticks += 1
+
+            next_tick += self.period
+            if next_tick < now:
+                next_tick = now + self.period  # we fell behind; don't try to catch up in a burst
+
+            if duration is not None:
+                next_tick = min(next_tick, started + duration)
+
+            preempted = self.preempted.wait(max(next_tick - time.monotonic(), 0))
+
+        return LoopStats(
+            name=name,
+            ticks=ticks,
+            seconds=time.monotonic() - started,
+            cpu_seconds=time.thread_time() - cpu_started,
+            mean_jitter_ms=jitter_total / ticks * 1000 if ticks else 0.0,
+            max_jitter_ms=jitter_max * 1000,
+            preempted=preempted
+        )
@@ -1,8 +1,24 @@
+import itertools
+import math
 import rospy
+import threading
 import time
 
+from collections import namedtuple
 from geometry_msgs.msg import Twist
 
+from ControlLoop import ControlLoop
+from PoseCache import PoseCache
+from VelocityProfile import TRAPEZOID, profile, ramp_down
+
+ANGLE_TOLERANCE = math.radians(2)
+DISTANCE_TOLERANCE = 0.01  # m
+CREEP_TIMEOUT = 2  # sec we'll creep toward a target the profile fell short of
+
+# achieved and error are in the target's units (radians or meters), and are
+# None when there was no odometry to measure them by
+MotionResult = namedtuple('MotionResult', ['primitive', 'target', 'achieved', 'error', 'closed_loop', 'stats'])
+
 class Drive():
     """Drives the Create 2
 
@@ -10,63 +26,185 @@ class Drive():
     >>> drive = Drive()
     >>> drive.forward(speed=0.5)
 
+    forward and spin stream acceleration-limited velocity profiles, and steer
+    by ca_driver's odometry when it's fresh, stopping once the target distance
+    or angle is reached; without it they run the profile open loop. Both
+    return a MotionResult with the achieved error. stop ramps down from the
+    last commanded velocity.
     """
 
-    def __init__(self):
+    def __init__(self, control_hz=None):
         self.velocity_publisher = rospy.Publisher('/cmd_vel', Twist, queue_size=10)
 
+        # Set by preempt(); every primitive checks it at each control tick and
+        # returns early. Whoever starts the next primitive clears it.
+        self.preempted = threading.Event()
+
+        # Primitives republish their command at the driver's own loop rate: any
+        # faster is wasted, and any slower than its latch_cmd_duration and the
+        # driver stops the robot between our commands
+        driver_hz = rospy.get_param('/ca_driver/loop_hz', 10.0)
+        latch_duration = rospy.get_param('/ca_driver/latch_cmd_duration', 0.2)
+        control_hz = control_hz or rospy.get_param('~control_hz', driver_hz)
+        if 1.0 / control_hz >= latch_duration:
+            rospy.logwarn(f"control_hz {control_hz} is too slow for ca_driver's latch_cmd_duration of {latch_duration} sec")
+
+        self.control_loop = ControlLoop(control_hz, self.preempted)
+        self.primitive_stats = {}  # primitive name -> LoopStats of its last run
+
+        # Ramps that stop the robot run even when we've been preempted
+        self.ramp_loop = ControlLoop(control_hz, threading.Event())
+
+        # Moves accelerate and brake no harder than this, along a trapezoidal
+        # or s_curve profile (see VelocityProfile)
+        self.linear_accel = rospy.get_param('~max_linear_accel', 1.0)  # m/s^2
+        self.angular_accel = rospy.get_param('~max_angular_accel', 3.0)  # rad/s^2
+        self.profile_shape = rospy.get_param('~velocity_profile', TRAPEZOID)
+
+        # The one command message, reused for every publish: rospy serializes
+        # it inside publish(), and only the motion worker thread publishes. It
+        # also holds the last velocity we commanded.
+        self.vel_msg = Twist()
+        self._linear = self.vel_msg.linear
+        self._angular = self.vel_msg.angular
+
+        # The running command's tracing.Trace, stamped and cleared at our first publish
+        self.trace = None
+
+        self.pose_cache = PoseCache(rospy.get_param('~odom_topic', '/odom'))
+
+    def preempt(self):
+        """Makes the running primitive return at its next control tick
+        """
+        self.preempted.set()
+
+    def set_velocity(self, vx, wz):
+        """Sets the reusable command message to (vx, wz) and returns it"""
+        self._linear.x = vx
+        self._angular.z = wz
+        return self.vel_msg
+
+    def _stamp_trace(self):
+        self.trace.first_publish = time.monotonic()
+        self.trace = None
+
+    def _run(self, name, velocity, duration, reached=None):
+        """Publishes velocity, a (vx, wz), at the control rate for duration
+        seconds, or until reached() returns True"""
+        publish = self.velocity_publisher.publish
+
+        def tick():
+            if reached is not None and reached():
+                return False
+            publish(self.set_velocity(*velocity))
+            if self.trace is not None:
+                self._stamp_trace()
+
+        return self._log_stats(name, self.control_loop.run(name, tick, duration=duration))
+
+    def _stream(self, name, schedule, reached=None, loop=None):
+        """Publishes a precomputed schedule, one (vx, wz) per control tick,
+        until it runs out or reached() returns True"""
+        ticks = iter(schedule)
+        publish = self.velocity_publisher.publish
+
+        def tick():
+            if reached is not None and reached():
+                return False
+
+            velocity = next(ticks, None)
+            if velocity is None:
+                return False
+            publish(self.set_velocity(*velocity))
+            if self.trace is not None:
+                self._stamp_trace()
+
+        return self._log_stats(name, (loop or self.control_loop).run(name, tick))
+
+    def _log_stats(self, name, stats):
+        self.primitive_stats[name] = stats
+
+        rospy.logdebug(f"{name}: {stats.ticks} ticks in {stats.seconds:.2f} sec, "
+                       f"jitter {stats.mean_jitter_ms:.1f}/{stats.max_jitter_ms:.1f} ms mean/max, "
+                       f"cpu {stats.cpu_seconds * 1000:.1f} ms")
+        return stats
+
+    def _move(self, name, axis, target, speed, accel, progress, tolerance):
+        """Streams an acceleration-limited profile along axis (0 for linear, 1
+        for angular) covering target, stopping early once progress(start_pose,
+        pose) reaches it, then stops and measures how close we got. Without
+        fresh odometry it just streams the profile."""
+        speeds = profile(target, speed, accel, self.control_loop.hz, self.profile_shape).tolist()
+        if axis == 0:
+            schedule = [(v, 0.0) for v in speeds]
+        else:
+            schedule = [(0.0, v) for v in speeds]
+
+        start = self.pose_cache.fresh()
+
+        if start is None:
+            stats = self._stream(name, schedule)
+            self.stop()
+            return MotionResult(name, target, None, None, False, stats)
+
+        def reached():
+            pose = self.pose_cache.fresh()
+            # Lost odometry mid-move: stop rather than drive blind
+            return pose is None or progress(start, pose) >= target - tolerance
+
+        stats = self._stream(name, schedule, reached=reached)
+        if schedule and not stats.preempted and not reached():
+            # The profile ran out short of the target (wheel slip, say): creep
+            # the rest of the way at the profile's slowest speed
+            creep = [schedule[0]] * int(CREEP_TIMEOUT * self.control_loop.hz)
+            self._stream(name + " creep", creep, reached=reached)
+        self.stop()
 
-    def forward(self, speed=0.5):
-        print(f"moving forward at speed {speed}")
+        achieved = progress(start, self.pose_cache.pose)
+        return MotionResult(name, target, achieved, achieved - target, True, stats)
 
-        vel_msg = Twist()
-        vel_msg.linear.x = abs(speed)
-        vel_msg.linear.y = 0
-        vel_msg.linear.z = 0
-        vel_msg.angular.x = 0
-        vel_msg.angular.y = 0
-        vel_msg.angular.z = 0
-        
-        self.velocity_publisher.publish(vel_msg)
+    def forward(self, speed=0.5, distance=None):
+        """Drives distance meters forward (by default, a second's worth at speed)
+        """
+        print(f"moving forward at speed {speed}")
 
-        time.sleep(1)
+        distance = abs(distance or speed)
+        return self._move("forward", 0, distance, abs(speed), self.linear_accel,
+                          lambda start, pose: pose.odometer - start.odometer, DISTANCE_TOLERANCE)
 
     def spin(self, speed=60, angle=360):
         print(f"spinning {angle} degrees at {speed}")
 
-        vel_msg = Twist()
-        PI = 3.14159
-        angular_speed = speed * 2 * PI/360
-        relative_angle = angle * 2 * PI/360
-        
-        vel_msg.linear.x = 0
-        vel_msg.linear.y = 0
-        vel_msg.linear.z = 0
-        vel_msg.angular.x = 0
-        vel_msg.angular.y = 0
-        vel_msg.angular.z = abs(angular_speed)
-
-        t0 = rospy.Time.now().to_sec()
-        current_angle = 0
-
-        while(current_angle < relative_angle):
-            self.velocity_publisher.publish(vel_msg)
-            t1 = rospy.Time.now().to_sec()
-            current_angle = angular_speed * (t1-t0)
-        
+        angular_speed = math.radians(abs(speed))
+        relative_angle = math.radians(abs(angle))
+
+        return self._move("spin", 1, relative_angle, angular_speed, self.angular_accel,
+                          lambda start, pose: abs(pose.heading - start.heading), ANGLE_TOLERANCE)
+
+    def run_schedule(self, schedule, name="script"):
+        """Publishes a precomputed velocity schedule, one (vx, wz) per control
+        tick, then stops. Open loop: the schedule already says how long each
+        step takes."""
+        print(f"running {name} of {len(schedule) / self.control_loop.hz:.1f} sec")
+
+        stats = self._stream(name, schedule)
         self.stop()
 
+        return MotionResult(name, len(schedule), stats.ticks, stats.ticks - len(schedule), False, stats)
+
     def stop(self):
         print(f"stopping movement")
 
-        vel_msg = Twist()
-        vel_msg.linear.x = 0
-        vel_msg.linear.y = 0
-        vel_msg.linear.z = 0
-        vel_msg.angular.x = 0
-        vel_msg.angular.y = 0
-        vel_msg.angular.z = 0
-
-        self.velocity_publisher.publish(vel_msg) # forces stop
-
-        time.sleep(1)
\ No newline at end of file
+        # Decelerate from whatever we were last doing, even if we've been
+        # preempted, so a cancelled move still halts without skidding
+        vx, wz = self._linear.x, self._angular.z
+        linear = ramp_down(vx, self.linear_accel, self.control_loop.hz, self.profile_shape).tolist()
+        angular = ramp_down(wz, self.angular_accel, self.control_loop.hz, self.profile_shape).tolist()
+        if linear or angular:
+            self._stream("ramp down", list(itertools.zip_longest(linear, angular, fillvalue=0.0)), loop=self.ramp_loop)
+
+        self.velocity_publisher.publish(self.set_velocity(0.0, 0.0))
+        if self.trace is not None:
+            self._stamp_trace()
+        stats = self._run("stop", (0.0, 0.0), duration=1) # forces stop
+        return MotionResult("stop", 0, None, None, False, stats)
@@ -0,0 +1,89 @@
+"""Motion scripts: several primitives sent as one directive.
+
+The skill sends a compound move like "go forward then spin" as a single
+"script" directive whose data is a list of steps, each a primitive name and
+optionally its parameters:
+
+    {"directive":"script","data":{"steps":[["forward",{"distance":0.5}],["spin"]]}}
+
+compile_script turns the steps into a velocity schedule, one (vx, wz) per
+control tick, before the robot moves, so Drive.run_schedule only has to index
+into it from a single control loop. Given accelerations, each move follows an
+acceleration-limited profile from VelocityProfile rather than jumping to speed.
+"""
+import math
+
+from VelocityProfile import TRAPEZOID, profile
+
+# Parameters and defaults match Drive's primitives
+PRIMITIVES = {
+    "forward": {"speed": 0.5, "distance": None},  # m/s, m (a second's worth by default)
+    "spin": {"speed": 60, "angle": 360},  # deg/s, deg
+    "stop": {"duration": 1}  # sec standing still
+}
+
+MAX_STEPS = 16
+MAX_DURATION = 30  # sec, so a bad script can't drive off for minutes
+
+class ScriptError(ValueError):
+    """The script was malformed, used an unknown primitive, or ran too long"""
+
+def _parse_step(step):
+    if isinstance(step, str):
+        step = [step]
+    if not isinstance(step, (list, tuple)) or not 1 <= len(step) <= 2:
+        raise ScriptError(f"Bad step {step!r}")
+
+    name = step[0]
+    params = step[1] if len(step) == 2 else {}
+    if name not in PRIMITIVES:
+        raise ScriptError(f"Unknown primitive {name!r}")
+    if not isinstance(params, dict) or set(params) - set(PRIMITIVES[name]):
+        raise ScriptError(f"Bad parameters for {name}: {params!r}")
+
+    return name, dict(PRIMITIVES[name], **params)
+
+def _segment(name, params):
+    """(vx, wz, seconds) for one step"""
+    if name == "forward":
+        speed = abs(float(params["speed"]))
+        distance = abs(float(params["distance"] or speed))
+        return speed, 0.0, distance / speed if speed else 0.0
+
+    if name == "spin":
+        speed = abs(float(params["speed"]))
+        angle = abs(float(params["angle"]))
+        return 0.0, math.radians(speed), angle / speed if speed else 0.0
+
+    return 0.0, 0.0, abs(float(params["duration"]))
+
+def _speeds(speed, seconds, accel, hz, shape):
+    """Speed at each tick of a move at speed for seconds, profiled if accel is given"""
+    if accel is None or not speed:
+        return [speed] * round(seconds * hz)
+    return profile(speed * seconds, speed, accel, hz, shape).tolist()
+
+def compile_script(steps, hz, linear_accel=None, angular_accel=None, shape=TRAPEZOID):
+    """The velocity schedule for a script: a list of (vx, wz), one per tick at
+    hz. Moves ramp at linear_accel (m/s^2) and angular_accel (rad/s^2), or
+    start and stop instantly if they're None. Raises ScriptError if the script
+    is no good."""
+    if not isinstance(steps, (list, tuple)) or not steps:
+        raise ScriptError("A script needs at least one step")
+    if len(steps) > MAX_STEPS:
+        raise ScriptError(f"Scripts are limited to {MAX_STEPS} steps")
+
+    segments = [_segment(*_parse_step(step)) for step in steps]
+    if sum(seconds for vx, wz, seconds in segments) > MAX_DURATION:
+        raise ScriptError(f"Scripts are limited to {MAX_DURATION} sec")
+
+    schedule = []
+    for vx, wz, seconds in segments:
+        if vx:
+            schedule.extend((v, 0.0) for v in _speeds(vx, seconds, linear_accel, hz, shape))
+        elif wz:
+            schedule.extend((0.0, w) for w in _speeds(wz, seconds, angular_accel, hz, shape))
+        else:
+            schedule.extend([(0.0, 0.0)] * round(seconds * hz))
+
+    return schedule
@@ -0,0 +1,54 @@
+import math
+import rospy
+import time
+
+from collections import namedtuple
+from nav_msgs.msg import Odometry
+
+# heading is unwrapped (it keeps growing past pi as the robot turns), and
+# odometer is the total distance driven, so progress through a primitive is a
+# subtraction between two poses
+Pose = namedtuple('Pose', ['x', 'y', 'yaw', 'heading', 'odometer', 'received'])
+
+def wrap_angle(angle):
+    """Wraps an angle in radians to [-pi, pi)"""
+    return (angle + math.pi) % (2 * math.pi) - math.pi
+
+class PoseCache():
+    """Latest pose from ca_driver's odometry
+
+    To use:
+    >>> poses = PoseCache()
+    >>> start = poses.pose
+    >>> turned = poses.pose.heading - start.heading
+
+    The pose is replaced as a whole on every message, so readers never need a
+    lock.
+    """
+
+    def __init__(self, topic='/odom', max_age=0.5):
+        self.max_age = max_age  # sec before a pose is too old to steer by
+        self.pose = None
+        self.subscriber = rospy.Subscriber(topic, Odometry, self._odom_callback, queue_size=1)
+
+    def _odom_callback(self, message):
+        position = message.pose.pose.position
+        q = message.pose.pose.orientation
+        yaw = math.atan2(2 * (q.w * q.z + q.x * q.y), 1 - 2 * (q.y * q.y + q.z * q.z))
+
+        last = self.pose
+        if last is None:
+            heading, odometer = yaw, 0.0
+        else:
+            heading = last.heading + wrap_angle(yaw - last.yaw)
+            odometer = last.odometer + math.hypot(position.x - last.x, position.y - last.y)
+
+        self.pose = Pose(position.x, position.y, yaw, heading, odometer, time.monotonic())
+
+    def fresh(self):
+        """The current pose, or None if we have none recent enough to close the loop on"""
+        pose = self.pose
+        if pose is None or time.monotonic() - pose.received > self.max_age:
+            return None
+
+        return pose
@@ -0,0 +1,83 @@
+"""Acceleration-limited velocity profiles for Drive's primitives.
+
+A profile is the commanded speed at every control tick of a move, as a NumPy
+array: it ramps up at no more than accel, cruises at speed, and ramps back down
+to zero, covering distance (meters, or radians for a spin) in total. Moves too
+short to reach speed get a triangular profile instead.
+
+TRAPEZOID ramps at a constant accel. S_CURVE ramps along a half cosine, so the
+acceleration itself starts and ends at zero (no jerk at the corners), peaking at
+accel; it takes pi/2 times as long to ramp.
+
+    >>> profile(0.5, 0.5, 1.0, 10)
+    array([0.05, 0.15, 0.25, ...])
+
+Profiles are cached by their parameters and returned read-only, so a repeated
+move costs a dictionary lookup.
+"""
+import math
+
+from functools import lru_cache
+
+import numpy as np
+
+TRAPEZOID = 'trapezoid'
+S_CURVE = 's_curve'
+
+def _ramp_time(speed, accel, shape):
+    """sec to get from standing to speed"""
+    if shape == S_CURVE:
+        return math.pi / 2 * speed / accel
+    return speed / accel
+
+@lru_cache(maxsize=64)
+def profile(distance, speed, accel, hz, shape=TRAPEZOID):
+    """Speed at each tick (sampled mid-tick) of a move covering distance"""
+    if shape not in (TRAPEZOID, S_CURVE):
+        raise ValueError("Unknown profile shape {!r}".format(shape))
+
+    distance, speed, accel = abs(distance), abs(speed), abs(accel)
+    if not distance or not speed:
+        return np.zeros(0)
+
+    # Each ramp covers speed * ramp_time / 2, whatever its shape
+    ramp = _ramp_time(speed, accel, shape)
+    if speed * ramp > distance:
+        # Triangular: peak where the two ramps meet
+        speed *= math.sqrt(distance / (speed * ramp))
+        ramp = _ramp_time(speed, accel, shape)
+
+    duration = ramp + distance / speed
+    ticks = max(int(math.ceil(duration * hz)), 1)
+    t = (np.arange(ticks) + 0.5) / hz
+
+    # Progress through whichever ramp we're on, 0 at standstill and 1 at speed
+    ramping = np.clip(np.minimum(t, duration - t) / ramp, 0.0, 1.0)
+    if shape == S_CURVE:
+        ramping = (1 - np.cos(np.pi * ramping)) / 2
+
+    velocities = speed * ramping
+    covered = velocities.sum() / hz
+    if not covered:
+        # Over in under half a tick, before the mid-tick sample: one tick covers it, below speed
+        velocities = np.full(1, distance * hz)
+    else:
+        # Sampling shaves a little off; scale back up so the move covers distance
+        velocities *= distance / covered
+
+    velocities.setflags(write=False)
+    return velocities
+
+def ramp_down(speed, accel, hz, shape=TRAPEZOID):
+    """Speeds that bring a move at speed to a stop without exceeding accel"""
+    speed, accel = abs(speed), abs(accel)
+    if not speed:
+        return np.zeros(0)
+
+    ramp = _ramp_time(speed, accel, shape)
+    t = (np.arange(max(int(math.ceil(ramp * hz)), 1)) + 0.5) / hz
+    ramping = np.clip(1 - t / ramp, 0.0, 1.0)
+    if shape == S_CURVE:
+        ramping = (1 - np.cos(np.pi * ramping)) / 2
+
+    return speed * ramping
@@ -0,0 +1,177 @@
+import json
+import queue
+import signal
+import threading
+import time
+
+import multiprocessing
+
+import rospy
+
+CAPTURE_FILENAME = "capture.jpg"
+STAGES = ("capture", "recognize_people", "detect_labels", "save_scene")
+
+def _serve(jobs, results):
+    """The worker process: takes capture jobs until it gets None"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the listener shuts us down
+
+    # Opens the PiCamera, so it's imported here and only here
+    import CameraImage
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+
+        timings = {}
+        errors = {}
+
+        def stage(name, run):
+            started = time.monotonic()
+            try:
+                return run()
+            except Exception as e:
+                errors[name] = str(e)
+            finally:
+                timings[name] = time.monotonic() - started
+
+        image = stage("capture", lambda: CameraImage.CameraImage(CAPTURE_FILENAME))
+        if image is not None:
+            # No faces in the picture is an error to Rekognition; carry on to labels
+            stage("recognize_people", image.recognize_people)
+            stage("detect_labels", image.detect_labels)
+
+            # The skill is waiting on the reply, not on the S3 upload and DDB write
+            results.put(("scene", job, image.scene(job['session_id'], job.get('correlation_id'))))
+            stage("save_scene", lambda: image.save_scene(job['session_id'], job.get('correlation_id')))
+
+        results.put(("done", job, timings, errors))
+
+class VisionWorker():
+    """Takes pictures and describes them in a separate process, so the
+    listener's MQTT and motion threads keep running at full rate (and the GIL
+    stays theirs) while Rekognition and S3 take their seconds.
+
+    To use:
+    >>> vision = VisionWorker(reply)
+    >>> vision.start()  # before any other threads start: it forks
+    >>> vision.submit({"session_id": ..., "reply_topic": ..., "correlation_id": ...})
+
+    The worker process owns the PiCamera. Each job runs capture,
+    recognize_people and detect_labels, passes the scene to reply(topic,
+    payload) for the job's reply_topic, if it has one, then runs save_scene
+    for the S3 upload and DDB write. submit
+    never blocks; jobs beyond max_pending are dropped. Per-stage times are
+    kept for snapshot().
+    """
+
+    def __init__(self, reply, max_pending=2):
+        self.reply = reply
+        self.processed = 0
+        self.dropped = 0
+        self.stage_stats = {stage: [0, 0, 0.0, 0.0] for stage in STAGES}  # stage -> [count, errors, total sec, max sec]
+        self._stopping = False  # set by shutdown(), so the watcher knows the exit was asked for
+
+        # Forked rather than spawned: spawning would re-run the listener script
+        # in the worker. Fork before the node starts any threads.
+        context = multiprocessing.get_context('fork')
+        self.jobs = context.Queue(max_pending)
+        self.results = context.Queue()
+        self.process = context.Process(target=_serve, args=(self.jobs, self.results), name="vision-worker", daemon=True)
+        self._collector = threading.Thread(target=self._collect, name="vision-results", daemon=True)
+        self._watcher = threading.Thread(target=self._watch, name="vision-watcher", daemon=True)
+
+    def start(self):
+        self.process.start()
+        self._collector.start()
+        self._watcher.start()
+
+    def shutdown(self, timeout=5):
+        self._stopping = True
+        try:
+            self.jobs.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+        self.results.put(None)
+        self._collector.join(timeout)
+
+    def submit(self, job):
+        """Queues a capture job without blocking; False if the worker is too far
+        behind or has died"""
+        if not self.process.is_alive():
+            self.dropped += 1
+            rospy.logerr(f"Vision worker isn't running (exit code {self.process.exitcode}), "
+                         f"dropped capture for {job.get('session_id')}")
+            return False
+
+        try:
+            self.jobs.put_nowait(job)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            rospy.logwarn(f"Vision worker is busy, dropped capture for {job.get('session_id')}")
+            return False
+
+    def _collect(self):
+        """Replies with each scene as soon as the worker has described it, then
+        records the job's stage times once it's saved"""
+        while True:
+            result = self.results.get()
+            if result is None:
+                return
+
+            kind, job = result[:2]
+            if kind == "scene":
+                self._reply(job, result[2])
+                continue
+
+            timings, errors = result[2:]
+            self.processed += 1
+            for name, seconds in timings.items():
+                stats = self.stage_stats[name]
+                stats[0] += 1
+                stats[1] += name in errors
+                stats[2] += seconds
+                stats[3] = max(stats[3], seconds)
+
+            if errors:
+                rospy.logwarn(f"Scene for {job.get('session_id')} had errors: {errors}")
+            rospy.logdebug(f"Scene for {job.get('session_id')} took " +
+                           ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in timings.items()))
+
+    def _watch(self):
+        """Blocks until the worker process exits, and logs it unless shutdown()
+        asked it to"""
+        self.process.join()
+        if not self._stopping:
+            rospy.logerr(f"Vision worker exited with code {self.process.exitcode}; "
+                         "check that CameraImage imports and the camera is free")
+
+    def _reply(self, job, scene):
+        if not job.get('reply_topic'):
+            return
+
+        try:
+            self.reply(job['reply_topic'], json.dumps(scene))
+        except Exception as e:
+            rospy.logerr(f"Couldn't reply with scene for {job.get('session_id')}: {e}")
+
+    def snapshot(self):
+        return {
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'stages': {
+                name: {
+                    'count': count,
+                    'errors': errors,
+                    'mean_ms': round(total / count * 1000, 1),
+                    'max_ms': round(longest * 1000, 1)
+                }
+                for name, (count, errors, total, longest) in self.stage_stats.items()
+                if count
+            }
+        }
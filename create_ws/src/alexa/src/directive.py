@@ -0,0 +1,140 @@
+"""Freshness and duplicate checks for directives sent by the skill.
+
+Every directive starts with a fixed header, its send time (epoch seconds), how
+many seconds it's good for, and a unique id:
+
+    {"ts":1700000000.123,"ttl":5,"id":"9f1c...","directive":"forward","data":{}}
+
+so the listener can reject a stale command, e.g. a QoS1 redelivery or an
+offline-queue replay from a minute ago, or one it has already executed, by
+peeking at the first few bytes instead of parsing the whole message.
+"""
+import threading
+import time
+
+from collections import OrderedDict
+
+HEADER_PREFIX = b'{"ts":'
+TTL_KEY = b',"ttl":'
+ID_KEY = b',"id":"'
+
+def peek_header(payload):
+    """(sent_at, ttl, id) from the front of a directive, or None if it has no
+    header. id is None for directives stamped before ids were added."""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+
+    if not payload.startswith(HEADER_PREFIX):
+        return None
+
+    ts_end = payload.find(TTL_KEY, len(HEADER_PREFIX))
+    ttl_end = payload.find(b',', ts_end + len(TTL_KEY))
+    if ts_end < 0 or ttl_end < 0:
+        return None
+
+    directive_id = None
+    if payload.startswith(ID_KEY, ttl_end):
+        id_end = payload.find(b'"', ttl_end + len(ID_KEY))
+        if id_end > 0:
+            directive_id = payload[ttl_end + len(ID_KEY):id_end]
+
+    try:
+        return float(payload[len(HEADER_PREFIX):ts_end]), float(payload[ts_end + len(TTL_KEY):ttl_end]), directive_id
+    except ValueError:
+        return None
+
+class SeenIds():
+    """Ids of recently executed directives, as an LRU that forgets an id after
+    max_age seconds and never holds more than max_size of them.
+
+    Every entry lives for the same max_age from when it was last seen, so the
+    oldest is always first: lookups, inserts and expiry are all O(1).
+    """
+
+    def __init__(self, max_size=1024, max_age=60):
+        self.max_size = max_size
+        self.max_age = max_age  # sec; longer than any ttl plus clock skew
+        self.evicted = 0
+        self._ids = OrderedDict()  # id -> time.monotonic() it expires
+
+    def __len__(self):
+        return len(self._ids)
+
+    def seen(self, directive_id, now=None):
+        """True if directive_id was already seen; remembers it either way.
+        Not thread safe on its own."""
+        now = now or time.monotonic()
+
+        while self._ids:
+            oldest, expires = next(iter(self._ids.items()))
+            if expires > now:
+                break
+            del self._ids[oldest]
+
+        duplicate = directive_id in self._ids
+        self._ids[directive_id] = now + self.max_age
+        self._ids.move_to_end(directive_id)
+
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+            self.evicted += 1
+
+        return duplicate
+
+class DirectiveStats():
+    """Counts fresh, expired and duplicate directives, and the transit latency
+    (send to receive) of the ones that had a header"""
+
+    def __init__(self, clock_skew=0.5, seen_ids=None):
+        self.clock_skew = clock_skew  # sec of tolerance between the skill's clock and ours
+        self.seen_ids = seen_ids if seen_ids is not None else SeenIds()
+        self.accepted = 0
+        self.expired = 0
+        self.duplicates = 0
+        self.unstamped = 0
+        self.latency_count = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self._lock = threading.Lock()
+
+    def is_fresh(self, payload, now=None):
+        """True if the directive should be executed: it hasn't expired and we
+        haven't executed it already. Counts it either way."""
+        header = peek_header(payload)
+        if header is None:
+            with self._lock:
+                self.unstamped += 1
+                self.accepted += 1
+            return True
+
+        sent_at, ttl, directive_id = header
+        age = max((now or time.time()) - sent_at, 0.0)
+
+        with self._lock:
+            self.latency_count += 1
+            self.latency_total += age
+            self.latency_max = max(self.latency_max, age)
+
+            if age > ttl + self.clock_skew:
+                self.expired += 1
+                return False
+
+            if directive_id is not None and self.seen_ids.seen(directive_id):
+                self.duplicates += 1
+                return False
+
+            self.accepted += 1
+            return True
+
+    def snapshot(self):
+        received = self.accepted + self.expired + self.duplicates
+        return {
+            'accepted': self.accepted,
+            'expired': self.expired,
+            'duplicates': self.duplicates,
+            'duplicate_rate': round(self.duplicates / received, 4) if received else None,
+            'unstamped': self.unstamped,
+            'seen_ids': len(self.seen_ids),
+            'mean_latency_ms': round(self.latency_total / self.latency_count * 1000, 1) if self.latency_count else None,
+            'max_latency_ms': round(self.latency_max * 1000, 1)
+        }
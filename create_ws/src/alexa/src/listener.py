@@ -3,7 +3,6 @@
 import rospy
 import boto3
 import sys
-import signal
 import time
 import json
 import os
@@ -12,6 +11,19 @@ from io import BytesIO
 from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
 
 from Drive import *
+from CommandExecutor import CommandExecutor
+from directive import DirectiveStats, SeenIds
+from runtime import Runtime
+from topic_routing import TopicRouter
+from tracing import LatencyTracer
+from offline_queue import DROP_OLDEST, OfflinePublishQueue, QueuedPublisher
+from VisionWorker import VisionWorker
+
+# Pictures are taken and described in their own process, which owns the
+# camera. It forks, so start it before the MQTT client or rospy start threads.
+# Scenes go back to the skill through publisher, set up below.
+vision = VisionWorker(lambda topic, payload: publisher.publish(topic, payload, 1, ttl=scene_reply_ttl))
+vision.start()
 
 endpoint = os.environ['AWS_IOT_ENDPOINT'] # Set this up in your bash profile
 
@@ -20,50 +32,124 @@ createMQTTClient = AWSIoTMQTTClient("TwitchRobotRaspberryPi")
 createMQTTClient.configureEndpoint(endpoint, 443)
 
 createMQTTClient.configureCredentials("/home/pi/TwitchRobot/certs/AmazonRootCA1.crt", "/home/pi/TwitchRobot/certs/TwitchRobot.private.key", "/home/pi/TwitchRobot/certs/TwitchRobot.cert.pem")
-createMQTTClient.configureOfflinePublishQueueing(-1)  # Infinite offline Publish queueing
-createMQTTClient.configureDrainingFrequency(2)  # Draining: 2 Hz
+createMQTTClient.configureOfflinePublishQueueing(0)  # Offline publishes are queued by publisher, below
 createMQTTClient.configureConnectDisconnectTimeout(10)  # 10 sec
 createMQTTClient.configureMQTTOperationTimeout(5)  # 5 sec
 
-createMQTTClient.connect()
-
 # Initialize the node
 rospy.init_node('alexa', anonymous=True)
+
+# Handles SIGINT and SIGTERM from here on; SIGUSR1 logs CPU use and wakeups
+runtime = Runtime()
+runtime.install()
+
+# Publish through this rather than createMQTTClient, so that messages sent while
+# we're offline wait in a bounded queue and stale ones are dropped
+publisher = QueuedPublisher(createMQTTClient, OfflinePublishQueue(
+    max_size=rospy.get_param('~offline_queue_size', 20),
+    drop_policy=rospy.get_param('~offline_drop_policy', DROP_OLDEST)
+), max_hz=rospy.get_param('~drain_max_hz', 50))
+createMQTTClient.onOnline = publisher.on_online
+createMQTTClient.onOffline = publisher.on_offline
+
+createMQTTClient.connect()
+publisher.on_online()
+
 drive = Drive()
 
+# Motion runs on its own thread, so the MQTT callback thread is never blocked
+# by a primitive and can always deliver a "stop"
+executor = CommandExecutor(drive, max_pending=rospy.get_param('~max_pending_commands', 8))
+executor.start()
+
+# Commands older than their ttl, or that we've already run (QoS1 redeliveries),
+# are dropped unread
+directive_stats = DirectiveStats(clock_skew=rospy.get_param('~clock_skew', 0.5), seen_ids=SeenIds(
+    max_size=rospy.get_param('~seen_ids_size', 1024),
+    max_age=rospy.get_param('~seen_ids_max_age', 60)
+))
+
+scene_reply_ttl = rospy.get_param('~scene_reply_ttl', 6)  # sec the skill waits for a scene
+
+# Where the time goes between the skill and /cmd_vel, published every
+# ~metrics_interval sec with the directive stats above, and written per
+# directive to ~trace_log if it's set
+metrics_interval = rospy.get_param('~metrics_interval', 60)
+tracer = LatencyTracer(
+    lambda topic, payload: publisher.publish(topic, payload, 0, ttl=metrics_interval),
+    topic=rospy.get_param('~metrics_topic', "/robot/metrics/latency"),
+    interval=metrics_interval,
+    trace_log=rospy.get_param('~trace_log', None),
+    directive_stats=directive_stats
+)
+tracer.start()
+
+# Every AWS IoT topic we handle, and its handler, is registered with this
+router = TopicRouter()
+
 def unsubscribe_topics():
     """Unbsubscribes from AWS IoT topics before exiting
     """
+    router.unsubscribe(createMQTTClient)
 
-    topics = [ '/voice/drive' ]
-
-    for topic in topics:
-        createMQTTClient.unsubscribe(topic)
-
-# Interrupt Handler useful to break out of the script
-def interrupt_handler(signum, frame):
-    unsubscribe_topics()
+def shutdown():
+    """Unsubscribes, reports and stops the motion worker before exiting
+    """
+    try:
+        unsubscribe_topics()
+        createMQTTClient.disconnect()
+    except Exception as e:
+        rospy.logwarn(f"Couldn't unsubscribe cleanly: {e}")
+
+    print(f"Directives: {directive_stats.snapshot()}")
+    print(f"Commands: {executor.snapshot()}")
+    print(f"Topics: {router.snapshot()}")
+    print(f"Vision: {vision.snapshot()}")
+    print(f"Offline queue: {publisher.queue.stats()}, last replay: {publisher.last_replay}")
+    print(f"Latency: {tracer.snapshot()}")
+    print(f"Runtime: {runtime.usage()}")
+    executor.shutdown()
+    vision.shutdown()
+    tracer.shutdown()
     sys.exit("Exited and unsubscribed")
 
+def log_motion(future):
+    """Logs how a queued command turned out, once the motion worker is done with it"""
+    if future.cancelled():
+        rospy.logdebug("Command cancelled before it ran")
+    elif future.exception() is not None:
+        rospy.logwarn(f"Command failed: {future.exception()}")
+    else:
+        rospy.logdebug(f"Command done: {future.result()}")
+
 # Custom MQTT message callbacks
+@router.topic("/voice/drive")
 def driveCallback(client, userdata, message):
-    print(f"Received {message.payload} from {message.topic}")
-    payload = json.loads(message.payload)
-    command = payload['data']
-    print(f"Processing command: {command}")
-    
-    if command == "forward":
-        drive.forward()
-        drive.stop()
-    elif command == "spin":
-        drive.spin()
+    received_at, received = time.time(), time.monotonic()
+
+    if directive_stats.is_fresh(message.payload, now=received_at):
+        directive = json.loads(message.payload)
+        command = directive['directive']
+        trace = tracer.trace(directive, received_at, received)
+        executor.submit(command, trace=trace, **(directive.get('data') or {})).add_done_callback(log_motion)
+        rospy.logdebug(f"Queued command {command} from {message.topic}")
+    else:
+        rospy.logdebug(f"Dropped expired or duplicate command from {message.topic}")
+
+@router.topic("/camera")
+def cameraCallback(client, userdata, message):
+    if directive_stats.is_fresh(message.payload):
+        job = json.loads(message.payload)['data']
+        vision.submit(job)
+        rospy.logdebug(f"Queued capture for {job.get('session_id')}")
+    else:
+        rospy.logdebug(f"Dropped expired or duplicate capture from {message.topic}")
 
 # Subscribe to topics
-createMQTTClient.subscribe("/voice/drive", 1, driveCallback)
-print("Listening on /voice/drive")
-
-while True:
-    signal.signal(signal.SIGINT, interrupt_handler)
-    time.sleep(1)
+router.subscribe(createMQTTClient)
+print(f"Listening on {', '.join(router.subscriptions())}")
 
-unsubscribe_topics()
+# Everything happens on the MQTT and motion threads, so the main thread just
+# blocks until Ctrl-C, SIGTERM or rospy shuts us down
+runtime.wait()
+shutdown()
@@ -0,0 +1,312 @@
+"""Bounded offline publish queue for the skill's and the robot's MQTT clients.
+
+The AWS IoT SDK's own offline queue is unbounded (-1) or drops blindly, and it
+replays everything, however stale. OfflinePublishQueue holds at most max_size
+messages, drops the oldest or the newest when full, expires each message after
+its ttl, and coalesces messages that supersede each other: a queued "stop" on
+/voice/drive replaces a queued "forward" instead of following it.
+
+Every publish is stamped with a sequence number when it's made, and the queue
+remembers the newest one sent for each coalesce_key, so a "forward" that was
+queued, or popped for a replay, before a "stop" went out directly is dropped
+rather than replayed after it.
+
+QueuedPublisher puts it in front of an AWSIoTMQTTClient (configured with
+configureOfflinePublishQueueing(0), so the SDK queues nothing itself):
+
+    >>> publisher = QueuedPublisher(client, OfflinePublishQueue(max_size=20))
+    >>> client.onOnline = publisher.on_online
+    >>> client.onOffline = publisher.on_offline
+    >>> publisher.publish("/voice/drive", payload, 1, ttl=5, coalesce_key="/voice/drive")
+
+This file is shared with the Lambda function through a symlink in lambda/.
+"""
+import contextlib
+import itertools
+import logging
+import threading
+import time
+
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+
+class QueuedMessage(namedtuple('QueuedMessage', ['topic', 'payload', 'qos', 'queued_at', 'expires_at', 'coalesce_key', 'sequence'])):
+    __slots__ = ()
+
+    def expired(self, now=None):
+        return self.expires_at is not None and self.expires_at <= (now or time.monotonic())
+
+class OfflinePublishQueue():
+    """Messages waiting for the connection to come back, oldest first. With
+    max_size=0 nothing is queued: every put is counted as a dropped_newest."""
+
+    def __init__(self, max_size=20, drop_policy=DROP_OLDEST):
+        if drop_policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("Unknown drop policy {!r}".format(drop_policy))
+        if max_size < 0:
+            raise ValueError("max_size can't be negative, got {}".format(max_size))
+
+        self.max_size = max_size
+        self.drop_policy = drop_policy
+
+        self.dropped = {DROP_OLDEST: 0, DROP_NEWEST: 0}
+        self.expired = 0
+        self.coalesced = 0
+
+        self._messages = OrderedDict()  # slot -> QueuedMessage
+        self._coalesced = {}  # coalesce_key -> slot
+        self._last_sent = {}  # coalesce_key -> sequence of the newest message sent
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def next_sequence(self):
+        """Stamp for a message about to be published, newer than any before it"""
+        with self._lock:
+            return next(self._sequence)
+
+    def _remove(self, slot):
+        message = self._messages.pop(slot)
+        if message.coalesce_key is not None:
+            self._coalesced.pop(message.coalesce_key, None)
+        return message
+
+    def _superseded(self, message):
+        """True if a newer message with the same coalesce_key has been sent or
+        queued. Call with the lock held."""
+        key = message.coalesce_key
+        if key is None:
+            return False
+
+        if self._last_sent.get(key, -1) > message.sequence:
+            return True
+
+        slot = self._coalesced.get(key)
+        return slot is not None and self._messages[slot].sequence > message.sequence
+
+    def superseded(self, message):
+        with self._lock:
+            return self._superseded(message)
+
+    def put(self, topic, payload, qos=1, ttl=None, coalesce_key=None, sequence=None):
+        """Queues a message, returning False if the drop policy refused it or
+        something newer has superseded it. sequence is its next_sequence()
+        stamp from when it was published; by default, now."""
+        now = time.monotonic()
+
+        with self._lock:
+            if sequence is None:
+                sequence = next(self._sequence)
+            message = QueuedMessage(topic, payload, qos, now, now + ttl if ttl else None, coalesce_key, sequence)
+
+            if self._superseded(message):
+                self.coalesced += 1
+                return False
+
+            if coalesce_key is not None and coalesce_key in self._coalesced:
+                self._remove(self._coalesced[coalesce_key])
+                self.coalesced += 1
+
+            if len(self._messages) >= self.max_size:
+                if self.drop_policy == DROP_NEWEST or not self._messages:
+                    self.dropped[DROP_NEWEST] += 1
+                    logger.warning("Offline queue full, dropped new message to {}: {}".format(topic, self.stats()))
+                    return False
+
+                oldest = self._remove(next(iter(self._messages)))
+                self.dropped[DROP_OLDEST] += 1
+            else:
+                oldest = None
+
+            slot = next(self._sequence)
+            self._messages[slot] = message
+            if coalesce_key is not None:
+                self._coalesced[coalesce_key] = slot
+
+            if oldest is not None:
+                logger.warning("Offline queue full, dropped oldest message to {}: {}".format(oldest.topic, self.stats()))
+
+        return True
+
+    def pop(self):
+        """Oldest message that hasn't expired or been superseded, or None when
+        there's nothing left"""
+        now = time.monotonic()
+
+        with self._lock:
+            while self._messages:
+                message = self._remove(next(iter(self._messages)))
+                if message.expired(now):
+                    self.expired += 1
+                elif self._superseded(message):
+                    self.coalesced += 1
+                else:
+                    return message
+
+        return None
+
+    def requeue(self, message):
+        """Puts a popped message back at the front, unless something newer has
+        been sent or queued since"""
+        with self._lock:
+            if self._superseded(message):
+                self.coalesced += 1
+                return False
+
+            slot = next(self._sequence)
+            self._messages[slot] = message
+            self._messages.move_to_end(slot, last=False)
+            if message.coalesce_key is not None:
+                self._coalesced[message.coalesce_key] = slot
+
+        return True
+
+    def sent(self, coalesce_key, sequence):
+        """Records that the message stamped sequence went out, dropping any
+        older one still queued with this coalesce_key"""
+        with self._lock:
+            if sequence <= self._last_sent.get(coalesce_key, -1):
+                return
+            self._last_sent[coalesce_key] = sequence
+
+            slot = self._coalesced.get(coalesce_key)
+            if slot is not None and self._messages[slot].sequence < sequence:
+                self._remove(slot)
+                self.coalesced += 1
+
+    def oldest_age(self):
+        """Seconds the oldest queued message has been waiting, None if empty"""
+        with self._lock:
+            if not self._messages:
+                return None
+            return time.monotonic() - next(iter(self._messages.values())).queued_at
+
+    def stats(self):
+        return {
+            'depth': len(self._messages),
+            'dropped_oldest': self.dropped[DROP_OLDEST],
+            'dropped_newest': self.dropped[DROP_NEWEST],
+            'expired': self.expired,
+            'coalesced': self.coalesced
+        }
+
+class QueuedPublisher():
+    """Publishes through an MQTT client, queueing in an OfflinePublishQueue
+    whenever the client is offline or a publish fails.
+
+    Once the client is back online, a background thread replays the queue
+    (publishing from the client's own callback thread could deadlock). The
+    replay rate adapts: a small, fresh backlog goes out in a burst at up to
+    max_hz, anything else starts at base_hz and speeds up while publishes
+    succeed. A failed publish, the broker pushing back, halves the rate and the
+    message is retried, up to max_retries times in a row. Expired messages are
+    skipped. last_replay records how long the last replay took.
+    """
+
+    def __init__(self, client, offline_queue, base_hz=2, max_hz=50, burst_size=10, burst_max_age=2, max_retries=5):
+        self.client = client
+        self.queue = offline_queue
+        self.base_hz = base_hz
+        self.max_hz = max_hz
+        self.burst_size = burst_size  # messages
+        self.burst_max_age = burst_max_age  # sec
+        self.max_retries = max_retries
+        self.online = False
+
+        self.last_replay = {'messages': 0, 'seconds': 0.0, 'final_hz': 0.0, 'throttled': 0}
+        self._draining = threading.Lock()
+        self._ordering = {}  # coalesce_key -> Lock held from the superseded check until it's sent
+
+    def on_online(self):
+        self.online = True
+        if len(self.queue):
+            threading.Thread(target=self.drain, name="mqtt-drain", daemon=True).start()
+
+    def on_offline(self):
+        self.online = False
+
+    def _ordered(self, coalesce_key):
+        """Serializes sends for one coalesce_key, so a message found current
+        can't be overtaken before it goes out"""
+        if coalesce_key is None:
+            return contextlib.nullcontext()
+        return self._ordering.setdefault(coalesce_key, threading.Lock())
+
+    def _send(self, message):
+        """Publishes a message unless something newer with its coalesce_key has
+        been sent already; False if it was superseded"""
+        with self._ordered(message.coalesce_key):
+            if self.queue.superseded(message):
+                return False
+
+            self.client.publish(message.topic, message.payload, message.qos)
+            if message.coalesce_key is not None:
+                self.queue.sent(message.coalesce_key, message.sequence)
+            return True
+
+    def publish(self, topic, payload, qos=1, ttl=None, coalesce_key=None):
+        """Publishes now if we can, otherwise queues; returns True if it was sent"""
+        sequence = self.queue.next_sequence()
+
+        if self.online:
+            try:
+                return self._send(QueuedMessage(topic, payload, qos, None, None, coalesce_key, sequence))
+            except Exception as e:
+                logger.warning("Publish to {} failed, queueing it: {}".format(topic, e))
+
+        self.queue.put(topic, payload, qos, ttl=ttl, coalesce_key=coalesce_key, sequence=sequence)
+        return False
+
+    def _starting_hz(self):
+        age = self.queue.oldest_age()
+        if len(self.queue) <= self.burst_size and age is not None and age <= self.burst_max_age:
+            return self.max_hz
+
+        return self.base_hz
+
+    def drain(self):
+        """Replays queued messages until the queue is empty or we go offline"""
+        if not self._draining.acquire(blocking=False):
+            return  # another thread is already at it
+
+        started = time.monotonic()
+        hz = self._starting_hz()
+        replayed = throttled = failures = 0
+
+        try:
+            while self.online and failures <= self.max_retries:
+                message = self.queue.pop()
+                if message is None:
+                    break
+
+                try:
+                    if not self._send(message):
+                        continue  # a newer one went out while this was in hand
+                    replayed += 1
+                    failures = 0
+                    hz = min(self.max_hz, hz + self.base_hz)
+                except Exception as e:
+                    # The broker is pushing back: slow down, and try it again unless it expires first
+                    throttled += 1
+                    failures += 1
+                    hz = max(self.base_hz / 4, hz / 2)
+                    self.queue.requeue(message)
+                    logger.warning("Replaying to {} failed, slowing to {:.1f} Hz: {}".format(message.topic, hz, e))
+
+                time.sleep(1.0 / hz)
+        finally:
+            self._draining.release()
+
+        self.last_replay = {
+            'messages': replayed,
+            'seconds': round(time.monotonic() - started, 3),
+            'final_hz': round(hz, 1),
+            'throttled': throttled
+        }
+        logger.info("Offline queue replayed {}: {}".format(self.last_replay, self.queue.stats()))
@@ -0,0 +1,66 @@
+"""Event-driven main thread for the listener node.
+
+All the node's work happens on other threads (MQTT callbacks, the motion
+worker), so the main thread only has to wait for shutdown. Runtime blocks it
+on an Event, which signals still interrupt, instead of sleeping in a loop:
+
+    >>> runtime = Runtime()
+    >>> runtime.install()
+    >>> runtime.wait()  # until Ctrl-C, SIGTERM or rospy shutdown
+
+Send the node SIGUSR1 to log its CPU use and wakeups so far; they're logged at
+shutdown too. Wakeups are voluntary context switches, for the whole process
+and for the main thread, which should have none while it waits.
+"""
+import os
+import resource
+import signal
+import threading
+import time
+
+import rospy
+
+class Runtime():
+    def __init__(self):
+        self.shutdown_requested = threading.Event()
+        self.started = time.monotonic()
+        self.cpu_started = time.process_time()
+        self.process_wakeups_started = resource.getrusage(resource.RUSAGE_SELF).ru_nvcsw
+        self.main_wakeups_started = resource.getrusage(resource.RUSAGE_THREAD).ru_nvcsw
+
+    def install(self):
+        """Registers the signal handlers (once, from the main thread) and a
+        rospy shutdown hook"""
+        signal.signal(signal.SIGINT, self.request_shutdown)
+        signal.signal(signal.SIGTERM, self.request_shutdown)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.log_usage())
+        rospy.on_shutdown(self.shutdown_requested.set)
+
+    def request_shutdown(self, signum=None, frame=None):
+        # Our handlers replace rospy's, so tell it too
+        rospy.signal_shutdown("signal {}".format(signum) if signum else "shutdown requested")
+        self.shutdown_requested.set()
+
+    def wait(self):
+        """Blocks until shutdown is requested"""
+        self.shutdown_requested.wait()
+
+    def usage(self):
+        """CPU use and wakeups per minute since we started. Call from the main
+        thread, so the main thread's wakeups are its own."""
+        uptime = max(time.monotonic() - self.started, 1e-9)
+        minutes = uptime / 60
+        process_wakeups = resource.getrusage(resource.RUSAGE_SELF).ru_nvcsw - self.process_wakeups_started
+        main_wakeups = resource.getrusage(resource.RUSAGE_THREAD).ru_nvcsw - self.main_wakeups_started
+
+        return {
+            'uptime_sec': round(uptime, 1),
+            'cpu_percent': round((time.process_time() - self.cpu_started) / uptime * 100, 3),
+            'wakeups_per_minute': round(process_wakeups / minutes, 1),
+            'main_thread_wakeups_per_minute': round(main_wakeups / minutes, 1),
+            'threads': threading.active_count(),
+            'pid': os.getpid()
+        }
+
+    def log_usage(self):
+        rospy.loginfo(f"Runtime: {self.usage()}")
@@ -0,0 +1,190 @@
+"""Routes MQTT messages to their handlers by topic filter.
+
+Handlers are registered for topic filters, MQTT wildcards included (+ for one
+level, # for the rest of the topic):
+
+    router = TopicRouter()
+
+    @router.topic("/voice/drive")
+    def driveCallback(client, userdata, message):
+        ...
+
+    router.subscribe(mqtt_client)
+
+The router subscribes once per filter that no other filter already covers, and
+its dispatch is the callback for all of them. Filters are stored in a trie
+keyed by topic level, and the handlers for each topic seen are cached, so a
+message costs one dict lookup however many filters are registered. Dispatch
+counts, rates and times are kept per filter.
+"""
+import threading
+import time
+
+import rospy
+
+MAX_CACHED_TOPICS = 1024
+
+class Route():
+    """A topic filter's handlers and their dispatch stats"""
+    __slots__ = ('topic_filter', 'handlers', 'qos', 'count', 'errors', 'total', 'longest', 'first', 'last')
+
+    def __init__(self, topic_filter, qos):
+        self.topic_filter = topic_filter
+        self.handlers = []
+        self.qos = qos
+        self.count = self.errors = 0
+        self.total = self.longest = 0.0  # sec
+        self.first = self.last = None  # time.monotonic() of the first and last message
+
+class _Node():
+    __slots__ = ('children', 'routes', 'rest')
+
+    def __init__(self):
+        self.children = {}  # topic level (or '+') -> _Node
+        self.routes = []  # routes whose filter ends here
+        self.rest = []  # routes whose filter ends with '#' here
+
+def _levels(topic_filter):
+    levels = topic_filter.split('/')
+    for i, level in enumerate(levels):
+        if ('#' in level and (level != '#' or i != len(levels) - 1)) or ('+' in level and level != '+'):
+            raise ValueError("Bad topic filter {!r}".format(topic_filter))
+    return levels
+
+def covers(broad, narrow):
+    """True if every topic matching the filter narrow also matches broad"""
+    broad, narrow = broad.split('/'), narrow.split('/')
+    for i, level in enumerate(broad):
+        if level == '#':
+            return True
+        if i >= len(narrow) or narrow[i] == '#' or (level != '+' and (narrow[i] == '+' or level != narrow[i])):
+            return False
+    return len(broad) == len(narrow)
+
+class TopicRouter():
+    """Maps MQTT topic filters to handler functions, called as MQTT callbacks
+    are: handler(client, userdata, message)"""
+
+    def __init__(self):
+        self.routes = {}  # topic filter -> Route
+        self.unmatched = 0
+
+        self._root = _Node()
+        self._cache = {}  # topic -> tuple of matching routes
+        self._lock = threading.Lock()
+
+    def topic(self, *topic_filters, qos=1):
+        """Registers the decorated function for these topic filters"""
+        def register(handler):
+            for topic_filter in topic_filters:
+                self.add(topic_filter, handler, qos)
+            return handler
+        return register
+
+    def add(self, topic_filter, handler, qos=1):
+        levels = _levels(topic_filter)
+
+        with self._lock:
+            route = self.routes.get(topic_filter)
+            if route is None:
+                route = self.routes[topic_filter] = Route(topic_filter, qos)
+
+                node = self._root
+                for level in levels[:-1] if levels[-1] == '#' else levels:
+                    node = node.children.setdefault(level, _Node())
+                (node.rest if levels[-1] == '#' else node.routes).append(route)
+
+            route.handlers.append(handler)
+            route.qos = max(route.qos, qos)
+            self._cache = {}
+
+    def match(self, topic):
+        """Routes whose filter matches topic"""
+        routes = self._cache.get(topic)
+        if routes is not None:
+            return routes
+
+        levels = topic.split('/')
+        found = []
+        stack = [(self._root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            found.extend(node.rest)  # '#' also matches the parent level itself
+            if depth == len(levels):
+                found.extend(node.routes)
+                continue
+
+            for level in (levels[depth], '+'):
+                child = node.children.get(level)
+                if child is not None:
+                    stack.append((child, depth + 1))
+
+        routes = tuple(found)
+        if len(self._cache) >= MAX_CACHED_TOPICS:
+            self._cache = {}
+        self._cache[topic] = routes
+        return routes
+
+    def dispatch(self, client, userdata, message):
+        """The MQTT callback for every subscription"""
+        routes = self.match(message.topic)
+        if not routes:
+            self.unmatched += 1
+            rospy.logwarn(f"No handler for {message.topic}")
+            return
+
+        for route in routes:
+            started = time.monotonic()
+            try:
+                for handler in route.handlers:
+                    handler(client, userdata, message)
+            except Exception as e:
+                route.errors += 1
+                rospy.logerr(f"Handler for {route.topic_filter} failed on {message.topic}: {e}")
+            finally:
+                finished = time.monotonic()
+                elapsed = finished - started
+                route.count += 1
+                route.total += elapsed
+                route.longest = max(route.longest, elapsed)
+                route.first = route.first or started
+                route.last = finished
+
+    def subscriptions(self):
+        """topic filter -> QoS to subscribe with, leaving out filters that
+        another one already covers"""
+        filters = sorted(self.routes)
+        subscriptions = {}
+        for topic_filter in filters:
+            broader = [other for other in filters if other != topic_filter and covers(other, topic_filter)]
+            if broader:
+                continue
+
+            covered = [route.qos for other, route in self.routes.items() if covers(topic_filter, other)]
+            subscriptions[topic_filter] = max(covered)
+
+        return subscriptions
+
+    def subscribe(self, client):
+        for topic_filter, qos in self.subscriptions().items():
+            client.subscribe(topic_filter, qos, self.dispatch)
+
+    def unsubscribe(self, client):
+        for topic_filter in self.subscriptions():
+            client.unsubscribe(topic_filter)
+
+    def snapshot(self):
+        """Per topic filter: message count, rate, errors, mean and max handler time"""
+        stats = {
+            route.topic_filter: {
+                'count': route.count,
+                'per_minute': round(route.count / max(route.last - route.first, 1) * 60, 1),
+                'errors': route.errors,
+                'mean_ms': round(route.total / route.count * 1000, 3),
+                'max_ms': round(route.longest * 1000, 3)
+            }
+            for route in self.routes.values()
+            if route.count
+        }
+        stats['unmatched'] = self.unmatched
+        return stats
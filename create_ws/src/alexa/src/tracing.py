@@ -0,0 +1,177 @@
+"""Voice-to-motion latency tracing.
+
+The skill stamps each directive with a trace, when its handler started and how
+long it took to get to format_mqtt_message:
+
+    {"ts":...,"ttl":5,"id":"9f1c...","trace":{"t0":1700000000.100,"skill_ms":1.9},"directive":"spin",...}
+
+and the robot adds monotonic stamps as the directive arrives in driveCallback,
+leaves the executor's queue, and first reaches /cmd_vel. Each finished trace is
+split into stages, using the directive id as its correlation id:
+
+    skill    handler start -> format_mqtt_message (the skill's clock)
+    transit  format_mqtt_message -> driveCallback (wall clocks, so it includes
+             any skew between the Lambda's and the Pi's)
+    queue    driveCallback -> dequeued by the motion worker
+    start    dequeued -> first /cmd_vel publish
+    total    the sum
+
+LatencyTracer keeps a histogram per stage and publishes them every interval
+seconds, along with the snapshot of a directive.DirectiveStats if it's given
+one (accepted, expired and duplicate counts and transit latency, traced or
+not); with trace_log set it also appends every trace as a JSON line, for
+bench/trace_report.py.
+"""
+import bisect
+import json
+import threading
+
+import rospy
+
+STAGES = ("skill", "transit", "queue", "start", "total")
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+class Histogram():
+    """Counts of values in BUCKETS_MS, plus count, total and max"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)  # the last is everything over the top bucket
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the pth percentile"""
+        if not self.count:
+            return None
+
+        target = self.count * p / 100
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count, 2) if self.count else None,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'max_ms': round(self.max, 2),
+            'buckets': [[bound, count] for bound, count in zip(BUCKETS_MS + ("inf",), self.counts) if count]
+        }
+
+class Trace():
+    """One directive's trip, stamped as it goes"""
+    __slots__ = ('tracer', 'cid', 'directive', 'sent_at', 'skill_ms', 'received_at', 'received',
+                 'dequeued', 'first_publish')
+
+    def __init__(self, tracer, cid, directive, sent_at, skill_ms, received_at, received):
+        self.tracer = tracer
+        self.cid = cid
+        self.directive = directive
+        self.sent_at = sent_at  # epoch sec the skill formatted it
+        self.skill_ms = skill_ms
+        self.received_at = received_at  # epoch sec
+        self.received = received  # time.monotonic() from here on
+        self.dequeued = None
+        self.first_publish = None
+
+    def finish(self):
+        """Records the trace, if it got as far as moving the robot"""
+        if self.dequeued is not None and self.first_publish is not None:
+            self.tracer.record(self)
+
+    def stages(self):
+        """ms per stage"""
+        stages = {
+            'skill': self.skill_ms,
+            'transit': max((self.received_at - self.sent_at) * 1000, 0.0),
+            'queue': (self.dequeued - self.received) * 1000,
+            'start': (self.first_publish - self.dequeued) * 1000
+        }
+        stages['total'] = sum(stages.values())
+        return stages
+
+class LatencyTracer():
+    """Aggregates finished traces into per-stage histograms, published as JSON
+    through publish(topic, payload) every interval seconds"""
+
+    def __init__(self, publish, topic="/robot/metrics/latency", interval=60, trace_log=None, directive_stats=None):
+        self.publish = publish
+        self.topic = topic
+        self.interval = interval
+        self.directive_stats = directive_stats
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self.traced = 0
+
+        self._log = open(trace_log, 'a', buffering=1) if trace_log else None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._reporter = threading.Thread(target=self._report, name="latency-metrics", daemon=True)
+        self._published = self.snapshot()  # as of the last publish, so an idle robot publishes nothing
+
+    def start(self):
+        self._reporter.start()
+
+    def shutdown(self):
+        self._stopped.set()
+        self._reporter.join(timeout=2)
+        if self._log:
+            self._log.close()
+
+    def trace(self, directive, received_at, received):
+        """A Trace for a parsed directive, or None if the skill didn't stamp one"""
+        stamp = directive.get('trace')
+        if not stamp or 'ts' not in directive:
+            return None
+
+        return Trace(self, directive.get('id'), directive.get('directive'), directive['ts'],
+                     stamp.get('skill_ms', 0.0), received_at, received)
+
+    def record(self, trace):
+        stages = trace.stages()
+
+        with self._lock:
+            self.traced += 1
+            for stage, ms in stages.items():
+                self.histograms[stage].add(ms)
+
+            if self._log:
+                self._log.write(json.dumps(dict(
+                    {stage + '_ms': round(ms, 3) for stage, ms in stages.items()},
+                    cid=trace.cid, directive=trace.directive, sent_at=trace.sent_at
+                )) + "\n")
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                'traced': self.traced,
+                'stages': {stage: histogram.snapshot() for stage, histogram in self.histograms.items()}
+            }
+
+        if self.directive_stats is not None:
+            snapshot['directives'] = self.directive_stats.snapshot()
+        return snapshot
+
+    def _report(self):
+        # One wakeup per interval, and only publishes when there's something new
+        while not self._stopped.wait(self.interval):
+            snapshot = self.snapshot()
+            if snapshot == self._published:
+                continue
+
+            self._published = snapshot
+            try:
+                self.publish(self.topic, json.dumps(snapshot))
+            except Exception as e:
+                rospy.logwarn(f"Couldn't publish latency metrics: {e}")
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""APL documents and datasources for RenderDocumentDirective.
+
+Documents are parsed once per container and kept until the file on disk
+changes. For deploys, `python3 apl.py` precompiles everything under ./apl into
+apl_compiled.py, so the JSON is never parsed at all in Lambda:
+
+    $ python3 apl.py
+    Compiled 2 APL documents into apl_compiled.py
+"""
+import json
+import os
+import pprint
+
+APL_DIR = 'apl'
+COMPILED_MODULE = 'apl_compiled.py'
+
+try:
+    from apl_compiled import DOCUMENTS as _compiled
+except ImportError:
+    _compiled = {}
+
+_cache = {}  # path -> (mtime, document)
+
+def load_document(file_path):
+    """Load the apl json document at the path into a dict object.
+
+    The returned dict is shared between requests, so don't modify it.
+    """
+    path = os.path.normpath(file_path)
+    if path in _compiled:
+        return _compiled[path]
+
+    mtime = os.stat(path).st_mtime
+    cached = _cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(path) as f:
+        document = json.load(f)
+
+    _cache[path] = (mtime, document)
+    return document
+
+def render_datasources(template, image_url, people, labels):
+    """Datasources for one scene: the template plus a 'scene' datasource.
+
+    Only the top level of the template is copied; everything else is shared.
+    """
+    datasources = dict(template)
+    datasources['scene'] = {
+        'imageUrl': image_url,
+        'people': people,
+        'labels': labels
+    }
+
+    return datasources
+
+def compile_documents(apl_dir=APL_DIR, module_path=COMPILED_MODULE):
+    """Writes every document in apl_dir into a python module as dict literals"""
+    documents = {}
+    if os.path.isdir(apl_dir):
+        for name in sorted(os.listdir(apl_dir)):
+            if name.endswith('.json'):
+                path = os.path.join(apl_dir, name)
+                with open(path) as f:
+                    documents[os.path.normpath(path)] = json.load(f)
+
+    with open(module_path, 'w') as f:
+        f.write("# Generated by apl.py from {}/*.json, do not edit\n".format(apl_dir))
+        f.write("DOCUMENTS = {}\n".format(pprint.pformat(documents)))
+
+    return len(documents)
+
+if __name__ == '__main__':
+    print("Compiled {} APL documents into {}".format(compile_documents(), COMPILED_MODULE))
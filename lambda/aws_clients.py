@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""boto3 clients, resources and DynamoDB tables shared by every handler.
+
+Each one is created the first time it's asked for and then kept for the life of
+the container, so warm invocations skip session construction, endpoint
+resolution and connection setup. Pool size and timeouts come from env variables.
+
+boto3 itself is only imported by the first lookup, so cold starts for intents
+that never touch AWS don't pay for it.
+"""
+import os
+import threading
+
+# botocore Config options for every client and resource
+BOTO_CONFIG = {
+    'max_pool_connections': int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 10)),
+    'connect_timeout': float(os.environ.get('AWS_CONNECT_TIMEOUT', 2)),  # sec
+    'read_timeout': float(os.environ.get('AWS_READ_TIMEOUT', 2)),  # sec
+    'retries': {'max_attempts': int(os.environ.get('AWS_MAX_ATTEMPTS', 3))}
+}
+
+class ClientRegistry():
+    """Lazily created, shared boto3 clients, resources and tables.
+
+    hits and misses count lookups that found an existing object and lookups
+    that had to build one; on a warm container misses should stay flat.
+    """
+
+    def __init__(self, config=None):
+        self.config = config  # a botocore Config; built from BOTO_CONFIG on first use if None
+        self.hits = 0
+        self.misses = 0
+        self._session = None
+        self._items = {}
+        self._lock = threading.RLock()
+
+    def _get(self, key, create):
+        item = self._items.get(key)
+        if item is not None:
+            self.hits += 1
+            return item
+
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                item = self._items[key] = create()
+            else:
+                self.hits += 1
+
+        return item
+
+    def session(self):
+        # Creating clients from one session isn't thread safe, which is why
+        # _get builds everything while holding the (reentrant) lock
+        with self._lock:
+            if self._session is None:
+                import boto3
+
+                from botocore.config import Config
+
+                if self.config is None:
+                    self.config = Config(**BOTO_CONFIG)
+                self._session = boto3.session.Session()
+            return self._session
+
+    def client(self, service_name):
+        return self._get(('client', service_name), lambda: self.session().client(service_name, config=self.config))
+
+    def resource(self, service_name):
+        return self._get(('resource', service_name), lambda: self.session().resource(service_name, config=self.config))
+
+    def table(self, table_name):
+        return self._get(('table', table_name), lambda: self.resource('dynamodb').Table(table_name))
+
+    def set_table(self, table_name, table):
+        """Uses an existing Table-like object for table_name, e.g. a local stand-in"""
+        with self._lock:
+            self._items[('table', table_name)] = table
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'cached': len(self._items)}
+
+registry = ClientRegistry()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Compares cold and warm publish latency for the skill's publish transports.
+
+A local stand-in for the IoT data plane is started on 127.0.0.1 (plain HTTP, or
+HTTPS if you give it a certificate), so this runs offline:
+
+    $ python3 bench/bench_transports.py
+    $ python3 bench/bench_transports.py --certfile cert.pem --keyfile key.pem
+
+"cold" is the first publish from a new transport, including connection setup
+(and the TLS handshake with --certfile), the way the first directive after a
+Lambda cold start pays for it. "warm" is every publish after that.
+
+To include the MQTT transport, pass --mqtt; it publishes to the real broker at
+AWS_IOT_ENDPOINT using the certificates in ./certs. Those numbers include the
+round trip to AWS, so they aren't comparable with the HTTPS numbers from the
+local stand-in: compare MQTT runs with each other, or run the HTTPS transport
+against the real data plane too. Every MQTT sample connects with its own client
+id from container_client_id() and disconnects when it's done, so samples don't
+take over each other's connections or the robot's.
+"""
+import argparse
+import http.client
+import os
+import ssl
+import statistics
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from transports import HTTPSTransport, MQTTTransport, container_client_id
+
+CREDENTIALS = ('./certs/AmazonRootCA1.crt', './certs/TwitchRobot.pem.key', './certs/TwitchRobot.pem.crt')
+PAYLOAD = b'{"directive":"spin","data":{}}'
+
+class DataPlaneHandler(BaseHTTPRequestHandler):
+    """Answers POST /topics/<topic> the way the IoT data plane does"""
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True  # otherwise delayed ACKs dominate warm publishes
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = b'{"message":"OK","traceId":"bench"}'
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stand_in(certfile=None, keyfile=None):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), DataPlaneHandler)
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def time_publishes(make_transport, cold_runs, warm_runs):
+    cold = []
+    for _ in range(cold_runs - 1):
+        transport = make_transport()
+        started = time.perf_counter()
+        transport.publish("/voice/drive", PAYLOAD, 1)
+        cold.append(time.perf_counter() - started)
+        transport.disconnect()
+
+    # The last cold transport stays connected for the warm publishes
+    transport = make_transport()
+    started = time.perf_counter()
+    transport.publish("/voice/drive", PAYLOAD, 1)
+    cold.append(time.perf_counter() - started)
+
+    warm = []
+    for _ in range(warm_runs):
+        started = time.perf_counter()
+        transport.publish("/voice/drive", PAYLOAD, 1)
+        warm.append(time.perf_counter() - started)
+
+    transport.disconnect()
+    return cold, warm
+
+def report(name, samples):
+    ms = sorted(s * 1000 for s in samples)
+    p95 = ms[min(len(ms) - 1, int(len(ms) * 0.95))]
+    print(f"{name:<14} n={len(ms):<5} median={statistics.median(ms):8.3f} ms  p95={p95:8.3f} ms  max={ms[-1]:8.3f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cold', type=int, default=20, help="number of cold publishes")
+    parser.add_argument('--warm', type=int, default=500, help="number of warm publishes")
+    parser.add_argument('--certfile', help="serve the stand-in over TLS with this certificate")
+    parser.add_argument('--keyfile', help="private key for --certfile")
+    parser.add_argument('--mqtt', action='store_true', help="also measure MQTT against AWS_IOT_ENDPOINT")
+    args = parser.parse_args()
+
+    server = start_stand_in(args.certfile, args.keyfile)
+    host, port = server.server_address
+
+    if args.certfile:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        make_https = lambda: HTTPSTransport(host, port=port, ssl_context=context)
+    else:
+        make_https = lambda: HTTPSTransport(host, port=port, connection_class=http.client.HTTPConnection)
+
+    cold, warm = time_publishes(make_https, args.cold, args.warm)
+    report("https cold", cold)
+    report("https warm", warm)
+
+    if args.mqtt:
+        make_mqtt = lambda: MQTTTransport(os.environ['AWS_IOT_ENDPOINT'], container_client_id("TwitchRobotBench"), CREDENTIALS)
+        cold, warm = time_publishes(make_mqtt, min(args.cold, 3), args.warm)
+        print(f"MQTT against {os.environ['AWS_IOT_ENDPOINT']}, not comparable with the local stand-in above:")
+        report("mqtt cold", cold)
+        report("mqtt warm", warm)
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
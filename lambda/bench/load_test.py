@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""Load test for lambda_handler, offline, with stand-ins for IoT and DynamoDB.
+
+Drives the skill with synthetic Alexa envelopes for every intent in en-US.json
+(plus LaunchRequest and SessionEndedRequest) and reports p50/p95/p99 latency:
+
+* cold: a fresh python process per sample, timing `import lambda_function` and
+  the first request, the way a Lambda cold start pays for them
+* warm: one process, --requests per intent sent from --concurrency threads,
+  followed by the router's own dispatch_times(), the time spent in each handler
+  without the SDK's request parsing and response serialization
+
+Publishes go to an in-process stand-in transport. A "/camera" directive is
+answered after --scene-delay seconds, both on the reply topic and in a stand-in
+TwitchRobot_Scenes table. Needs ask-sdk-core and boto3, nothing else:
+
+    $ python3 bench/load_test.py --concurrency 8 --requests 200
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCENE_TABLE = 'TwitchRobot_Scenes'
+EXTRA_REQUESTS = ["LaunchRequest", "SessionEndedRequest"]
+
+class FakeMessage():
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+class FakeSceneTable():
+    """Stands in for the TwitchRobot_Scenes DynamoDB table"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.items = {}
+
+    def put_item(self, Item):
+        time.sleep(self.latency)
+        self.items[Item['session_id']] = Item
+        return {}
+
+    def get_item(self, Key, ConsistentRead=False):
+        time.sleep(self.latency)
+        item = self.items.get(Key['session_id'])
+        return {'Item': item} if item else {}
+
+class FakeTransport():
+    """Stands in for the MQTT broker and the robot on the other side of it"""
+    supports_subscribe = True
+
+    publish_latency = 0.0
+    scene_delay = 0.0
+    table = None
+
+    def __init__(self, endpoint, client_id, credentials):
+        self.subscriptions = {}
+
+    def subscribe(self, topic, qos, callback):
+        self.subscriptions[topic] = callback
+
+    def publish(self, topic, payload, qos=1, ttl=None, coalesce_key=None):
+        time.sleep(self.publish_latency)
+        if topic == "/camera":
+            data = json.loads(payload)['data']
+            threading.Timer(self.scene_delay, self._reply_scene, (data,)).start()
+        return True
+
+    def _reply_scene(self, data):
+        scene = {'session_id': data['session_id'], 'correlation_id': data.get('correlation_id'),
+                 'recognized_people': ["Jeff"], 'labels': ["Robot", "Person"]}
+        self.table.put_item(Item=scene)
+
+        callback = self.subscriptions.get(data.get('reply_topic'))
+        if callback:
+            callback(None, None, FakeMessage(data['reply_topic'], json.dumps(scene).encode('utf-8')))
+
+def load_skill(args):
+    """Installs the stand-ins, then imports lambda_function.lambda_handler"""
+    os.chdir(LAMBDA_DIR)
+    sys.path.insert(0, LAMBDA_DIR)
+    os.environ.setdefault('AWS_IOT_ENDPOINT', 'localhost')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['MQTT_TRANSPORT'] = 'fake'
+
+    import aws_clients
+    import transports
+
+    FakeTransport.publish_latency = args.publish_latency
+    FakeTransport.scene_delay = args.scene_delay
+    FakeTransport.table = FakeSceneTable(args.ddb_latency)
+    transports.TRANSPORTS['fake'] = FakeTransport
+    aws_clients.registry.set_table(SCENE_TABLE, FakeTransport.table)
+
+    from lambda_function import lambda_handler
+    return lambda_handler
+
+def model_requests():
+    with open(os.path.join(LAMBDA_DIR, 'en-US.json')) as f:
+        model = json.load(f)
+
+    return [intent['name'] for intent in model['interactionModel']['languageModel']['intents']] + EXTRA_REQUESTS
+
+def slot(name, slot_type, value):
+    """A custom slot that resolved to value"""
+    return {
+        "name": name,
+        "value": value,
+        "confirmationStatus": "NONE",
+        "resolutions": {"resolutionsPerAuthority": [{
+            "authority": "amzn1.er-authority.echo-sdk.load-test." + slot_type,
+            "status": {"code": "ER_SUCCESS_MATCH"},
+            "values": [{"value": {"name": value, "id": value}}]
+        }]}
+    }
+
+def envelope(name):
+    """A minimal Alexa request envelope for an intent (or request type)"""
+    application = {"applicationId": "amzn1.ask.skill.load-test"}
+    user = {"userId": "amzn1.ask.account.load-test"}
+
+    if name in EXTRA_REQUESTS:
+        request = {"type": name}
+        if name == "SessionEndedRequest":
+            request["reason"] = "USER_INITIATED"
+    else:
+        request = {"type": "IntentRequest", "intent": {"name": name, "confirmationStatus": "NONE", "slots": {}}}
+
+    if name == "MoveDirectionIntent":
+        request["intent"]["slots"]["direction"] = slot("direction", "directions", "forward")
+    elif name == "MotionScriptIntent":
+        request["intent"]["slots"]["first"] = slot("first", "moves", "forward")
+        request["intent"]["slots"]["second"] = slot("second", "moves", "spin")
+
+    request.update({
+        "requestId": "amzn1.echo-api.request." + uuid.uuid4().hex,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "locale": "en-US"
+    })
+
+    return {
+        "version": "1.0",
+        "session": {
+            "new": False,
+            "sessionId": "amzn1.echo-api.session." + uuid.uuid4().hex,
+            "application": application,
+            "user": user
+        },
+        "context": {"System": {
+            "application": application,
+            "user": user,
+            "device": {"deviceId": "load-test", "supportedInterfaces": {}},
+            "apiEndpoint": "https://api.amazonalexa.com"
+        }},
+        "request": request
+    }
+
+def invoke(lambda_handler, name):
+    event = envelope(name)
+    started = time.perf_counter()
+    response = lambda_handler(event, None)
+    elapsed = time.perf_counter() - started
+
+    if 'response' not in response:
+        raise RuntimeError("{} returned {}".format(name, response))
+
+    return elapsed
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def report(path, name, samples):
+    ms = [s * 1000 for s in samples]
+    print("{:<5} {:<30} n={:<5} p50={:9.2f} ms  p95={:9.2f} ms  p99={:9.2f} ms".format(
+        path, name, len(ms), statistics.median(ms), percentile(ms, 95), percentile(ms, 99)))
+
+def cold_child(args):
+    started = time.perf_counter()
+    lambda_handler = load_skill(args)
+    imported = time.perf_counter() - started
+    first = invoke(lambda_handler, args.cold_child)
+    print(json.dumps({'import': imported, 'first': first}))
+
+def run_cold(args, names):
+    def sample(name):
+        command = [sys.executable, os.path.abspath(__file__), '--cold-child', name,
+                   '--scene-delay', str(args.scene_delay), '--publish-latency', str(args.publish_latency),
+                   '--ddb-latency', str(args.ddb_latency)]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        timings = json.loads(output.strip().splitlines()[-1])
+        return timings['import'] + timings['first']
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for name in names:
+            report("cold", name, list(pool.map(sample, [name] * args.cold)))
+
+def run_warm(args, names):
+    lambda_handler = load_skill(args)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for name in names:
+            invoke(lambda_handler, name)  # first call per intent isn't counted
+            report("warm", name, list(pool.map(lambda n: invoke(lambda_handler, n), [name] * args.requests)))
+
+    # Time inside each handler, as the router counted it, including the uncounted first calls
+    from lambda_function import router
+    print()
+    for name, times in router.dispatch_times().items():
+        print("{:<5} {:<30} n={:<5} mean={:8.2f} ms  max={:9.2f} ms".format(
+            "route", name, times['count'], times['mean_ms'], times['max_ms']))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=4, help="requests (or cold processes) in flight at once")
+    parser.add_argument('--requests', type=int, default=100, help="warm requests per intent")
+    parser.add_argument('--cold', type=int, default=3, help="cold starts per intent, 0 to skip")
+    parser.add_argument('--intent', action='append', help="only run this intent (repeatable)")
+    parser.add_argument('--scene-delay', type=float, default=0.5, help="sec the stand-in robot takes to describe a scene")
+    parser.add_argument('--publish-latency', type=float, default=0.0, help="sec per stand-in publish")
+    parser.add_argument('--ddb-latency', type=float, default=0.005, help="sec per stand-in DynamoDB call")
+    parser.add_argument('--cold-child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cold_child:
+        return cold_child(args)
+
+    names = args.intent or model_requests()
+    if args.cold:
+        run_cold(args, names)
+    if args.requests:
+        run_warm(args, names)
+
+if __name__ == '__main__':
+    main()
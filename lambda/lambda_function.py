@@ -4,32 +4,52 @@ import logging
 import os
 import time
 import json
-import boto3
+import uuid
 
-from ask_sdk_core.utils import is_intent_name, is_request_type, viewport
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import apl
+import aws_clients
+import routing
+
+from transports import container_client_id, create_transport
+
+from ask_sdk_core.utils import viewport
 from ask_sdk_model.ui import SimpleCard
 from ask_sdk_core.skill_builder import SkillBuilder
 
-from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
-
-from boto3.dynamodb.conditions import Key, Attr
 from botocore.exceptions import ClientError
 
 from ask_sdk_model.interfaces.alexa.presentation.apl import (
     RenderDocumentDirective, ExecuteCommandsDirective, SpeakItemCommand,
     AutoPageCommand, HighlightMode)
 
-createMQTTClient = AWSIoTMQTTClient("TwitchRobotController")
-createMQTTClient.configureEndpoint(os.environ['AWS_IOT_ENDPOINT'], 8883)
-createMQTTClient.configureCredentials('./certs/AmazonRootCA1.crt','./certs/TwitchRobot.pem.key', './certs/TwitchRobot.pem.crt')
-
-createMQTTClient.configureAutoReconnectBackoffTime(1, 32, 20)
-createMQTTClient.configureOfflinePublishQueueing(-1)  # Infinite offline Publish queueing
-createMQTTClient.configureDrainingFrequency(2)  # Draining: 2 Hz
-createMQTTClient.configureConnectDisconnectTimeout(10)  # 10 sec
-createMQTTClient.configureMQTTOperationTimeout(5)  # 5 sec
-
-createMQTTClient.connect()
+# Each container connects with its own client ID, so concurrent containers
+# don't kick each other off the broker
+MQTT_CLIENT_ID = container_client_id(os.environ.get('MQTT_CLIENT_ID_PREFIX', "TwitchRobotController"))
+
+# Scene results come back on a reply topic unique to this container
+SCENE_REPLY_TOPIC = "/camera/scenes/" + MQTT_CLIENT_ID
+_pending_scenes = {}  # correlation_id -> Future
+
+def sceneReplyCallback(client, userdata, message):
+    reply = json.loads(message.payload)
+    future = _pending_scenes.pop(reply.get('correlation_id'), None)
+    if future is not None:
+        future.set_result(reply)
+
+# Directives go out over MQTT by default, or over HTTPS with MQTT_TRANSPORT=https.
+# Either way nothing connects until the first directive is sent, so cold starts
+# for intents that never talk to the robot skip the TLS handshake.
+transport = create_transport(
+    os.environ.get('MQTT_TRANSPORT', 'mqtt'),
+    os.environ['AWS_IOT_ENDPOINT'],
+    MQTT_CLIENT_ID,
+    ('./certs/AmazonRootCA1.crt', './certs/TwitchRobot.pem.key', './certs/TwitchRobot.pem.crt')
+)
+
+if transport.supports_subscribe:
+    transport.subscribe(SCENE_REPLY_TOPIC, 1, sceneReplyCallback)
 
 SKILL_NAME = "The Create Robot Controller"
 HELP_MESSAGE = "You can tell the robot to move a direction, like move forward, or to spin around."
@@ -39,30 +59,132 @@ FALLBACK_MESSAGE = "Oops! This robot isn't smart enough, yet. Say something like
 FALLBACK_REPROMPT = 'What can I help you with?'
 EXCEPTION_MESSAGE = "Sorry. This robot cannot comply"
 
+STATIC_DIRECTIVES = ("spin", "stop", "forward", "back")
+# Values of the "moves" slot type -> (motion script step, how we say it)
+SCRIPT_STEPS = {"forward": (["forward"], "go forward"), "spin": (["spin"], "spin"), "stop": (["stop"], "wait")}
+SCRIPT_SLOTS = ("first", "second", "third")
+DRIVE_DIRECTIVE_TTL = float(os.environ.get('DRIVE_DIRECTIVE_TTL', 5))  # sec a drive command is worth sending (or executing) for
+MQTT_COMPACT_PAYLOADS = os.environ.get('MQTT_COMPACT_PAYLOADS', '1') == '1'
+_JSON_SEPARATORS = (',', ':') if MQTT_COMPACT_PAYLOADS else (', ', ': ')
+MQTT_TRACE = os.environ.get('MQTT_TRACE', '1') == '1'  # stamp directives for the robot's latency tracing
+
+INTERACTION_MODEL = os.environ.get('INTERACTION_MODEL', './en-US.json')
+
+SCENE_TABLE = 'TwitchRobot_Scenes'
+SCENE_WAIT_TIMEOUT = float(os.environ.get('SCENE_WAIT_TIMEOUT', 6))  # sec, keeps us under Alexa's 8 sec response limit
+SCENE_POLL_INITIAL = float(os.environ.get('SCENE_POLL_INITIAL', 0.25))  # sec before the first retry
+SCENE_POLL_MAX = float(os.environ.get('SCENE_POLL_MAX', 1))  # sec, cap on the backoff between reads
+ANNOTATED_IMAGE_URL = os.environ.get('ANNOTATED_IMAGE_URL', "https://jeffnunn-public.s3.amazonaws.com/annotated.jpg")
+SCENE_REPLY_TIMEOUT = float(os.environ.get('SCENE_REPLY_TIMEOUT', 4))  # sec to wait for the robot's reply before falling back to DDB
+
 sb = SkillBuilder()
+router = routing.IntentRouter()
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
 
-def _load_apl_document(file_path):
-    """Load the apl json document at the path into a dict object."""
-    with open(file_path) as f:
-        return json.load(f)
+# LOG_LEVEL applies to the skill's own modules; the root logger Lambda
+# attaches its handler to stays at WARNING, so boto3 doesn't flood the logs
+SKILL_LOGGERS = (__name__, 'transports', 'offline_queue', 'routing')
+for name in SKILL_LOGGERS:
+    logging.getLogger(name).setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
 
-def format_mqtt_message(directive, data):
-    payload = {}
-    payload['directive'] = directive
-    payload['data'] = data
-    
-    print("Payload")
-    print(json.dumps(payload))
-    
-    return json.dumps(payload)
+def _serialize_directive(directive, data):
+    return json.dumps({'directive': directive, 'data': data}, separators=_JSON_SEPARATORS).encode('utf-8')
+
+# Drive directives carry no data, so their bodies are serialized once per container
+_static_payloads = {directive: _serialize_directive(directive, {}) for directive in STATIC_DIRECTIVES}
+
+def format_mqtt_message(directive, data, ttl):
+    """Serialized directive, stamped with when it was sent, how many seconds
+    it's good for and a unique id. The stamp goes first, so the robot can
+    reject a stale or duplicate command by peeking at the header without
+    parsing the rest. Inside a handler, it also carries a trace: when the
+    handler started and how long it took to get here.
+    """
+    body = _static_payloads.get(directive) if not data else None
+    if body is None:
+        body = _serialize_directive(directive, data)
+
+    trace = b''
+    started = router.handler_started() if MQTT_TRACE else None
+    if started is not None:
+        trace = b'"trace":{"t0":%.3f,"skill_ms":%.3f},' % (started[0], (time.perf_counter() - started[1]) * 1000)
+
+    payload = b'{"ts":%.3f,"ttl":%g,"id":"%s",%s%s' % (time.time(), ttl, uuid.uuid4().hex.encode('ascii'), trace, body[1:])
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Payload {}".format(payload))
+
+    return payload
 
 def send_mqtt_directive(topic, directive, data = {}):
-    payload = format_mqtt_message(directive, data)
-    createMQTTClient.publish(topic, payload, 1)
+    if topic == "/voice/drive":
+        # A newer drive command replaces any still waiting to go out
+        payload = format_mqtt_message(directive, data, DRIVE_DIRECTIVE_TTL)
+        transport.publish(topic, payload, 1, ttl=DRIVE_DIRECTIVE_TTL, coalesce_key=topic)
+    else:
+        payload = format_mqtt_message(directive, data, SCENE_WAIT_TIMEOUT)
+        transport.publish(topic, payload, 1, ttl=SCENE_WAIT_TIMEOUT)
+
+def wait_for_scene(table, session_id, correlation_id, timeout=SCENE_WAIT_TIMEOUT):
+    """Polls DDB until the robot has saved the scene for this request.
+
+    The table keeps one item per session, so an item tagged with another
+    correlation_id is an earlier picture and we keep waiting. Backs off between
+    reads, doubling the delay up to SCENE_POLL_MAX, and returns the item as
+    soon as it matches or None once the deadline passes.
+    """
+    deadline = time.monotonic() + timeout
+    delay = SCENE_POLL_INITIAL
+
+    while True:
+        response = table.get_item(Key={'session_id': session_id}, ConsistentRead=True)
+        item = response.get('Item')
+        if item is not None and item.get('correlation_id') == correlation_id:
+            return item
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, SCENE_POLL_MAX)
+
+def request_scene(session_id, table):
+    """Asks the robot for a picture and waits for the scene it sees.
+
+    Every request carries its own correlation_id, which the robot echoes in
+    its reply and stores with the scene in DDB. The robot publishes the result
+    straight back on SCENE_REPLY_TOPIC; if that reply doesn't arrive within
+    SCENE_REPLY_TIMEOUT, we fall back to polling DDB for whatever time is left
+    of SCENE_WAIT_TIMEOUT. Transports that can't subscribe go straight to DDB.
+    """
+    started = time.monotonic()
+    correlation_id = uuid.uuid4().hex
+
+    if not transport.supports_subscribe:
+        send_mqtt_directive("/camera", "take a picture", data={
+            "session_id": session_id,
+            "correlation_id": correlation_id
+        })
+        return wait_for_scene(table, session_id, correlation_id)
+
+    future = _pending_scenes[correlation_id] = Future()
+
+    send_mqtt_directive("/camera", "take a picture", data={
+        "session_id": session_id,
+        "reply_topic": SCENE_REPLY_TOPIC,
+        "correlation_id": correlation_id
+    })
+
+    try:
+        return future.result(timeout=min(SCENE_REPLY_TIMEOUT, SCENE_WAIT_TIMEOUT))
+    except FutureTimeoutError:
+        _pending_scenes.pop(correlation_id, None)
 
-@sb.request_handler(can_handle_func = is_intent_name("SpinAroundIntent"))
+    remaining = SCENE_WAIT_TIMEOUT - (time.monotonic() - started)
+    return wait_for_scene(table, session_id, correlation_id, timeout=max(remaining, 0))
+
+@router.intent("SpinAroundIntent")
 def spin_around_intent_handler(handler_input):
     speech = "Ok, spinning"
     send_mqtt_directive("/voice/drive", "spin")
@@ -70,7 +192,35 @@ def spin_around_intent_handler(handler_input):
     handler_input.response_builder.speak(speech).set_card(SimpleCard(SKILL_NAME, speech)).set_should_end_session(False)
     return handler_input.response_builder.response
 
-@sb.request_handler(can_handle_func = is_intent_name("StopMovingIntent"))
+def resolved_slot_value(slot):
+    """Canonical value of a custom slot, or None if it wasn't filled or didn't resolve"""
+    if slot is None or slot.resolutions is None:
+        return None
+
+    for resolution in slot.resolutions.resolutions_per_authority:
+        if resolution.values:
+            return resolution.values[0].value.name
+
+    return None
+
+@router.intent("MotionScriptIntent")
+def motion_script_intent_handler(handler_input):
+    """Sends a compound move, like "go forward then spin", as one motion script
+    directive, so the robot runs it as a single trajectory"""
+    slots = handler_input.request_envelope.request.intent.slots or {}
+    moves = [resolved_slot_value(slots.get(name)) for name in SCRIPT_SLOTS]
+    moves = [move for move in moves if move is not None]
+
+    if moves and all(move in SCRIPT_STEPS for move in moves):
+        speech = "Ok, I'll {}".format(" then ".join(SCRIPT_STEPS[move][1] for move in moves))
+        send_mqtt_directive("/voice/drive", "script", data={"steps": [SCRIPT_STEPS[move][0] for move in moves]})
+    else:
+        speech = "Hmm. I can only string together moving forward, spinning, and stopping."
+
+    handler_input.response_builder.speak(speech).set_card(SimpleCard(SKILL_NAME, speech)).set_should_end_session(False)
+    return handler_input.response_builder.response
+
+@router.intent("StopMovingIntent")
 def stop_moving_intent_handler(handler_input):
     speech = "Ok, I'll stop the robot"
     send_mqtt_directive("/voice/drive", "stop")
@@ -78,36 +228,34 @@ def stop_moving_intent_handler(handler_input):
     handler_input.response_builder.speak(speech).set_card(SimpleCard(SKILL_NAME, speech)).set_should_end_session(False)
     return handler_input.response_builder.response
     
-@sb.request_handler(can_handle_func = is_intent_name("PictureIntent"))
+@router.intent("PictureIntent")
 def picture_intent_handler(handler_input):
     """
     Takes a picture and reads out the results
     
     1) Get session ID
-    2) send an mqtt message
-    3) wait with time.sleep(x)
-    4) Query DDB for the results
-    5) APL to show the image (if on a supported device)
+    2) send an mqtt message carrying our reply topic
+    3) Wait for the robot's reply, or poll DDB if it doesn't come in time
+    4) APL to show the image (if on a supported device)
     """
     session_id = handler_input.request_envelope.session.session_id
-    send_mqtt_directive("/camera", "take a picture", data={"session_id":session_id})
-    
-    time.sleep(3) # Let's give the backend process a little time to 1) take a picture, 2) recognize people and objects, and 3) upload details to DDB
-    
-    dynamodb = boto3.resource("dynamodb")
-    table = dynamodb.Table('TwitchRobot_Scenes')
+
+    table = aws_clients.registry.table(SCENE_TABLE)
+    logger.debug("AWS client registry: {}".format(aws_clients.registry.stats()))
 
     speech = "Got it. "
+    item = None
+    camera_error = False
 
     try:
-        response = table.get_item(Key={'session_id': session_id})
+        # The backend process needs to 1) take a picture, 2) recognize people and objects, and 3) upload details to DDB
+        item = request_scene(session_id, table)
     except ClientError as e:
         print(e.response['Error']['Message'])
         speech = "I had trouble getting anything back from the camera."
+        camera_error = True
     
-    if response and 'Item' in response:
-        item = response['Item']
-        
+    if item:
         recognized_people = False
         recognized_labels = False
         
@@ -118,6 +266,7 @@ def picture_intent_handler(handler_input):
                 speech += person + ", "
         
         if len(item['labels']) > 0:
+            recognized_labels = True
             if recognized_people:
                 speech += "I also see: "
             else:
@@ -129,7 +278,7 @@ def picture_intent_handler(handler_input):
         if not recognized_people and not recognized_labels:
             speech += "I didn't detect anything in the scene."
             
-    else:
+    elif not camera_error:
         speech += "I didn't detect anything in the scene."
 
     # See if APL is supported:
@@ -139,23 +288,29 @@ def picture_intent_handler(handler_input):
 
     else: 
         # Return speech and use APL to show the image
+        scene = item or {}
         handler_input.response_builder.speak(speech).set_card(SimpleCard(SKILL_NAME, speech)).add_directive(
                 RenderDocumentDirective(
                     token="pictureToken",
-                    document=_load_apl_document("./apl/document.json"),
-                    datasources=_load_apl_document("./apl/data.json")
+                    document=apl.load_document("./apl/document.json"),
+                    datasources=apl.render_datasources(
+                        apl.load_document("./apl/data.json"),
+                        image_url=scene.get('image_url', ANNOTATED_IMAGE_URL),
+                        people=scene.get('recognized_people', []),
+                        labels=scene.get('labels', [])
+                    )
                 )
             ).set_should_end_session(False)
 
     return handler_input.response_builder.response
 
-@sb.request_handler(can_handle_func = is_intent_name("MoveDirectionIntent"))
+@router.intent("MoveDirectionIntent")
 def move_direction_intent_handler(handler_input):
-    print("In Move Direction Handler")
+    logger.debug("In Move Direction Handler")
     # Parse direction from event
     direction_value = handler_input.request_envelope.request.intent.slots['direction'].resolutions.resolutions_per_authority[0].values[0].value.name
     
-    print("Direction value:", direction_value)
+    logger.debug("Direction value: {}".format(direction_value))
     if direction_value.find('forw') == 0:
         direction = "forward"
         speech = "Ok, moving forward"
@@ -168,19 +323,19 @@ def move_direction_intent_handler(handler_input):
         direction = False
         speech = "Hmm. Please ask me to move only forward, backwards, or to spin."
 
-    print("Send to MQTT")
+    logger.debug("Sent to MQTT")
 
     handler_input.response_builder.speak(speech).set_card(SimpleCard(SKILL_NAME, speech)).set_should_end_session(False)
     return handler_input.response_builder.response
 
-@sb.request_handler(can_handle_func=is_request_type("LaunchRequest"))
+@router.request("LaunchRequest")
 def launch_request_handler(handler_input):
     speech = "Hi! I'm your friendly robot! You can give me commands like move forward, move backwards, or spin around!"
    
     handler_input.response_builder.speak(speech).set_card(SimpleCard(SKILL_NAME, speech)).set_should_end_session(False)
     return handler_input.response_builder.response
 
-@sb.request_handler(can_handle_func = is_intent_name("HelloWorldIntent"))
+@router.intent("HelloWorldIntent")
 def hello_world_intent_handler(handler_input):
     
     speech = "Hi! I'm your friendly robot! You can give me commands like move forward, move backwards, or spin around!"
@@ -188,31 +343,41 @@ def hello_world_intent_handler(handler_input):
     handler_input.response_builder.speak(speech).set_card(SimpleCard(SKILL_NAME, speech)).set_should_end_session(False)
     return handler_input.response_builder.response
 
-@sb.request_handler(can_handle_func = is_intent_name("AMAZON.HelpIntent"))
+@router.intent("AMAZON.HelpIntent")
 def help_intent_hanlder(handler_input):
     return handler_input.response_builder.speak(HELP_MESSAGE).ask(HELP_REPROMPT).set_card(SimpleCard(SKILL_NAME, HELP_MESSAGE)).response
 
-@sb.request_handler(can_handle_func = (is_intent_name("AMAZON.CancelIntent") or is_intent_name("AMAZON.StopIntent")))
+@router.intent("AMAZON.CancelIntent", "AMAZON.StopIntent")
 def cancel_or_stop_intent_handler(handler_input):
     return handler_input.response_builder.speak(STOP_MESSAGE).response
 
-@sb.request_handler(can_handle_func = is_intent_name("AMAZON.FallbackIntent"))
+# The display navigation built-ins are in the model, but mean nothing to this skill
+@router.intent("AMAZON.FallbackIntent", "AMAZON.NavigateHomeIntent", "AMAZON.NavigateSettingsIntent",
+               "AMAZON.MoreIntent", "AMAZON.NextIntent", "AMAZON.PreviousIntent",
+               "AMAZON.PageUpIntent", "AMAZON.PageDownIntent", "AMAZON.ScrollUpIntent",
+               "AMAZON.ScrollDownIntent", "AMAZON.ScrollLeftIntent", "AMAZON.ScrollRightIntent")
 def fallback_intent_handler(handler_input):
     return handler_input.response_builder.speak(FALLBACK_MESSAGE).ask(FALLBACK_REPROMPT).set_card(SimpleCard(SKILL_NAME, FALLBACK_MESSAGE)).response
 
-@sb.request_handler(can_handle_func = is_request_type("SessionEndedRequest"))
+@router.request("SessionEndedRequest")
 def session_ended_request(handler_input):
     logger.info("In SessionEndedRequestHandler")
     logger.info("Session ended reason: {}".format(handler_input.request_envelope.request.reason))
+    logger.info("Dispatch times in this container: {}".format(router.dispatch_times()))
     return handler_input.response_builder.response
 
+# Every intent in the interaction model needs a handler, or we refuse to start
+router.validate(routing.load_model_intents(INTERACTION_MODEL))
+sb.request_handler(can_handle_func = router.can_handle)(router.handle)
+
 @sb.exception_handler(can_handle_func = lambda i, e: 'AskSdk' in e.__class__.__name__)
 def ask_exception_intent_handler(handler_input, exception):
     return handler_input.response_builder.speak(EXCEPTION_MESSAGE).ask(HELP_REPROMPT).response
 
 @sb.global_request_interceptor()
 def request_logger(handler_input):
-    print("Request received: {}".format(handler_input.request_envelope.request))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Request received: {}".format(handler_input.request_envelope.request))
 
 # Handler name that is used on AWS lambda
 lambda_handler = sb.lambda_handler()
\ No newline at end of file
@@ -0,0 +1 @@
+../create_ws/src/alexa/src/offline_queue.py
\ No newline at end of file
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Routes skill requests to their handlers with one dict lookup.
+
+The SDK tries every registered handler's can_handle in turn. Instead, the skill
+registers a single SDK handler backed by an IntentRouter, which keys handlers by
+(request type, intent name):
+
+    router = IntentRouter()
+
+    @router.intent("SpinAroundIntent")
+    def spin_around_intent_handler(handler_input):
+        ...
+
+    router.validate(load_model_intents("./en-US.json"))
+    sb.request_handler(can_handle_func=router.can_handle)(router.handle)
+"""
+import json
+import logging
+import threading
+import time
+
+from ask_sdk_core.utils import get_intent_name, get_request_type
+
+logger = logging.getLogger(__name__)
+
+INTENT_REQUEST = "IntentRequest"
+
+def load_model_intents(model_path):
+    """Names of every intent in an interaction model (e.g. ask/model/en-US.json)"""
+    with open(model_path) as f:
+        model = json.load(f)
+
+    return [intent['name'] for intent in model['interactionModel']['languageModel']['intents']]
+
+class IntentRouter():
+    """Maps (request type, intent name) to a handler function.
+
+    Intent names are None for requests other than IntentRequest. Dispatch
+    counts and times are kept per route in stats, and handler_started() tells
+    a handler when its dispatch began.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.stats = {}  # route -> [dispatches, total seconds, max seconds]
+        self._local = threading.local()
+
+    def _add(self, route, handler):
+        if route in self.routes:
+            raise ValueError("{} is already handled by {}".format(route, self.routes[route].__name__))
+
+        self.routes[route] = handler
+        self.stats[route] = [0, 0.0, 0.0]
+
+    def request(self, *request_types):
+        """Registers the decorated function for these request types"""
+        def register(handler):
+            for request_type in request_types:
+                self._add((request_type, None), handler)
+            return handler
+        return register
+
+    def intent(self, *intent_names):
+        """Registers the decorated function for these intents"""
+        def register(handler):
+            for intent_name in intent_names:
+                self._add((INTENT_REQUEST, intent_name), handler)
+            return handler
+        return register
+
+    def validate(self, intent_names):
+        """Raises if any of the intents (usually the interaction model's) has no handler"""
+        missing = [name for name in intent_names if (INTENT_REQUEST, name) not in self.routes]
+        if missing:
+            raise RuntimeError("No handler for intents: {}".format(", ".join(missing)))
+
+    def route(self, handler_input):
+        request_type = get_request_type(handler_input)
+        if request_type == INTENT_REQUEST:
+            return (request_type, get_intent_name(handler_input))
+
+        return (request_type, None)
+
+    def can_handle(self, handler_input):
+        return self.route(handler_input) in self.routes
+
+    def handle(self, handler_input):
+        route = self.route(handler_input)
+        started = time.perf_counter()
+        self._local.started = (time.time(), started)
+
+        try:
+            return self.routes[route](handler_input)
+        finally:
+            self._local.started = None
+            elapsed = time.perf_counter() - started
+            stats = self.stats[route]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+            logger.debug("Dispatched {} in {:.2f} ms".format(route[1] or route[0], elapsed * 1000))
+
+    def handler_started(self):
+        """(epoch sec, perf_counter) this thread's handler was dispatched at, or
+        None outside a handler"""
+        return getattr(self._local, 'started', None)
+
+    def dispatch_times(self):
+        """Per route name: dispatch count, mean and max time in ms"""
+        return {
+            (intent_name or request_type): {
+                'count': count,
+                'mean_ms': round(total / count * 1000, 3),
+                'max_ms': round(longest * 1000, 3)
+            }
+            for (request_type, intent_name), (count, total, longest) in self.stats.items()
+            if count
+        }
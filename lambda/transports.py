@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""Ways for the skill to publish directives to the robot through AWS IoT.
+
+MQTTTransport keeps a persistent AWSIoTMQTTClient, connected lazily and reused
+across warm invocations. HTTPSTransport publishes through the IoT data plane
+(https://<endpoint>:8443/topics/<topic>) over pooled keep-alive connections, so
+there are no background threads to keep alive between invocations, but it can't
+subscribe to anything.
+
+Pick one with create_transport(), usually from the MQTT_TRANSPORT env variable.
+"""
+import http.client
+import logging
+import os
+import queue
+import ssl
+import threading
+import time
+import uuid
+
+from urllib.parse import quote
+
+from offline_queue import DROP_OLDEST, OfflinePublishQueue, QueuedPublisher
+
+OFFLINE_QUEUE_SIZE = int(os.environ.get('MQTT_OFFLINE_QUEUE_SIZE', 20))
+OFFLINE_DROP_POLICY = os.environ.get('MQTT_OFFLINE_DROP_POLICY', DROP_OLDEST)
+DRAIN_MAX_HZ = float(os.environ.get('MQTT_DRAIN_MAX_HZ', 50))  # ceiling on replay rate after a reconnect
+
+logger = logging.getLogger(__name__)
+
+class PublishError(Exception):
+    """Raised when the broker refuses a publish"""
+
+def container_client_id(prefix):
+    """A client ID unique to this container: the prefix plus a random suffix.
+
+    Concurrent Lambda containers sharing one client ID keep kicking each other
+    off the broker, so each gets its own. It's made once per container and kept
+    for its lifetime, so warm invocations reconnect as the same client.
+    """
+    return "{}-{}".format(prefix, uuid.uuid4().hex[:12])
+
+class ConnectionMetrics():
+    """Counts connects and disconnects, and how long we spent getting back online"""
+
+    def __init__(self):
+        self.connects = 0
+        self.disconnects = 0
+        self.connect_seconds = 0.0  # spent inside connect() calls
+        self.reconnect_seconds = 0.0  # offline, from a disconnect until we're back online
+        self._offline_since = None
+        self._lock = threading.Lock()
+
+    def connected(self):
+        with self._lock:
+            self.connects += 1
+            if self._offline_since is not None:
+                self.reconnect_seconds += time.monotonic() - self._offline_since
+                self._offline_since = None
+
+    def disconnected(self):
+        with self._lock:
+            self.disconnects += 1
+            self._offline_since = time.monotonic()
+
+    def connect_took(self, seconds):
+        with self._lock:
+            self.connect_seconds += seconds
+
+    def snapshot(self):
+        return {
+            'connects': self.connects,
+            'disconnects': self.disconnects,
+            'connect_seconds': round(self.connect_seconds, 3),
+            'reconnect_seconds': round(self.reconnect_seconds, 3)
+        }
+
+class MQTTTransport():
+    """Publishes over a persistent MQTT connection.
+
+    The connection is made on the first publish, and only remade if the client
+    has reported itself offline since. Subscriptions are remembered and applied
+    every time we connect. While we can't connect, publishes wait in a bounded
+    OfflinePublishQueue and are replayed once we're back online.
+    """
+    supports_subscribe = True
+
+    def __init__(self, endpoint, client_id, credentials, port=8883):
+        self.endpoint = endpoint
+        self.client_id = client_id
+        self.credentials = credentials  # (root CA, private key, certificate)
+        self.port = port
+
+        self.client = None
+        self.publisher = None
+        self.offline_queue = OfflinePublishQueue(OFFLINE_QUEUE_SIZE, OFFLINE_DROP_POLICY)
+        self.online = False
+        self.subscriptions = {}  # topic -> (qos, callback)
+        self.metrics = ConnectionMetrics()
+        self._lock = threading.Lock()
+
+    def _on_online(self):
+        # Called by the client and by connect(), so only count the transition once
+        if not self.online:
+            self.online = True
+            self.metrics.connected()
+            self.publisher.on_online()
+
+    def _on_offline(self):
+        if self.online:
+            self.online = False
+            self.metrics.disconnected()
+            self.publisher.on_offline()
+
+    def _create_client(self):
+        from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
+
+        client = AWSIoTMQTTClient(self.client_id)
+        client.configureEndpoint(self.endpoint, self.port)
+        client.configureCredentials(*self.credentials)
+
+        client.configureAutoReconnectBackoffTime(1, 32, 20)
+        client.configureOfflinePublishQueueing(0)  # We queue offline publishes ourselves
+        client.configureConnectDisconnectTimeout(10)  # 10 sec
+        client.configureMQTTOperationTimeout(5)  # 5 sec
+
+        client.onOnline = self._on_online
+        client.onOffline = self._on_offline
+
+        self.publisher = QueuedPublisher(client, self.offline_queue, max_hz=DRAIN_MAX_HZ)
+
+        return client
+
+    def connect(self):
+        """Returns a connected client, connecting only if we aren't online"""
+        if self.online:
+            return self.client
+
+        with self._lock:
+            if self.online:
+                return self.client
+
+            if self.client is None:
+                self.client = self._create_client()
+            else:
+                # The socket died while we were frozen; drop it and start over
+                try:
+                    self.client.disconnect()
+                except Exception as e:
+                    logger.debug("Ignoring error while dropping dead connection: {}".format(e))
+
+            started = time.monotonic()
+            self.client.connect()
+            for topic, (qos, callback) in self.subscriptions.items():
+                self.client.subscribe(topic, qos, callback)
+            self._on_online()
+            self.metrics.connect_took(time.monotonic() - started)
+
+            logger.info("Connected to AWS IoT as {}: {}".format(self.client_id, self.metrics.snapshot()))
+
+        return self.client
+
+    def disconnect(self):
+        """Closes the connection, e.g. so a benchmark doesn't leave its client
+        id connected; the next publish connects again"""
+        with self._lock:
+            if self.client is not None:
+                self.client.disconnect()
+            self._on_offline()
+
+    def subscribe(self, topic, qos, callback):
+        self.subscriptions[topic] = (qos, callback)
+        if self.online:
+            self.client.subscribe(topic, qos, callback)
+
+    def publish(self, topic, payload, qos=1, ttl=None, coalesce_key=None):
+        """Publishes, or queues the message if we can't right now.
+
+        ttl is how many seconds the message is worth replaying for, and a
+        queued message with the same coalesce_key is replaced by this one.
+        """
+        try:
+            self.connect()
+        except Exception as e:
+            logger.warning("Couldn't connect to AWS IoT: {}".format(e))
+            if self.publisher is None:
+                raise
+
+        return self.publisher.publish(topic, payload, qos, ttl=ttl, coalesce_key=coalesce_key)
+
+class HTTPSTransport():
+    """Publishes with one HTTPS POST per message to the IoT data plane.
+
+    Connections are kept alive and pooled, so warm invocations skip the TLS
+    handshake. A connection the server has closed is replaced and the publish
+    retried once.
+    """
+    supports_subscribe = False
+
+    def __init__(self, endpoint, credentials=None, port=8443, pool_size=4, timeout=5,
+                 connection_class=http.client.HTTPSConnection, ssl_context=None):
+        self.endpoint = endpoint
+        self.port = port
+        self.timeout = timeout
+        self.connection_class = connection_class
+        self.ssl_context = ssl_context
+
+        if self.ssl_context is None and credentials is not None and connection_class is http.client.HTTPSConnection:
+            root_ca, private_key, certificate = credentials
+            self.ssl_context = ssl.create_default_context(cafile=root_ca)
+            self.ssl_context.load_cert_chain(certificate, private_key)
+
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self.metrics = ConnectionMetrics()
+
+    def _new_connection(self):
+        self.metrics.connected()
+        if self.connection_class is http.client.HTTPSConnection:
+            return self.connection_class(self.endpoint, self.port, timeout=self.timeout, context=self.ssl_context)
+
+        return self.connection_class(self.endpoint, self.port, timeout=self.timeout)
+
+    def _checkout(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._new_connection()
+
+    def _checkin(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def _post(self, connection, path, payload):
+        connection.request("POST", path, body=payload)
+        response = connection.getresponse()
+        body = response.read()  # the response has to be drained before the connection can be reused
+
+        return response.status, body
+
+    def disconnect(self):
+        """Closes every pooled connection"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def subscribe(self, topic, qos, callback):
+        raise NotImplementedError("The IoT data plane can't subscribe to topics")
+
+    def publish(self, topic, payload, qos=1, ttl=None, coalesce_key=None):
+        # Nothing is kept between invocations, so there's nothing to queue or coalesce
+        path = "/topics/{}?qos={}".format(quote(topic, safe=''), qos)
+        connection = self._checkout()
+
+        try:
+            status, body = self._post(connection, path, payload)
+        except (http.client.HTTPException, ConnectionError):
+            # Most likely the server closed an idle keep-alive connection
+            connection.close()
+            self.metrics.disconnected()
+            connection = self._new_connection()
+            status, body = self._post(connection, path, payload)
+
+        self._checkin(connection)
+
+        if status != 200:
+            raise PublishError("Publish to {} failed with {}: {}".format(topic, status, body))
+
+        return True
+
+# name -> factory(endpoint, client_id, credentials)
+TRANSPORTS = {
+    'mqtt': MQTTTransport,
+    'https': lambda endpoint, client_id, credentials: HTTPSTransport(endpoint, credentials)
+}
+
+def create_transport(name, endpoint, client_id, credentials):
+    """Builds the transport registered under name ('mqtt' or 'https')"""
+    if name not in TRANSPORTS:
+        raise ValueError("Unknown MQTT transport {!r}, expected one of {}".format(name, sorted(TRANSPORTS)))
+
+    return TRANSPORTS[name](endpoint, client_id, credentials)
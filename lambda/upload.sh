@@ -1,5 +1,6 @@
 #!/bin/bash
 
-zip -g lambda_function.zip lambda_function.py
+python3 apl.py # precompile APL documents into apl_compiled.py
+zip -g lambda_function.zip *.py en-US.json
 aws lambda update-function-code --function-name TwitchRobot --zip-file fileb://lambda_function.zip
 echo "Uploaded function to AWS Lambda"